@@ -21,8 +21,21 @@ NoNamio-Game version 1.2.1  11/03/2019
 
 import pygame
 import sys
+import os
+import mmap
+import struct
+import tempfile
+from array import array
+from collections import OrderedDict, deque
 from json import loads, dumps
-from random import choice
+from random import Random, randrange
+from time import perf_counter, strftime
+
+try:
+    import numpy
+except ImportError:
+    # без numpy враги обновляются по одному
+    numpy = None
 
 NEON = (57, 255, 20)
 RED = (255, 0, 0)
@@ -31,6 +44,50 @@ WHITE = (255, 255, 255)
 BLACK = (0, 0, 0)
 ORANGE = (255, 165, 0)
 
+# частота шагов физики, не зависит от частоты отрисовки
+TICK_RATE = 50
+# больше шагов за кадр не догоняем, иначе медленный компьютер зависнет
+MAX_TICKS_PER_FRAME = 10
+
+# биты маски нажатых кнопок для Simulation.step
+KEY_UP = 1
+KEY_RIGHT = 2
+KEY_LEFT = 4
+# направление движения героя для каждой кнопки (в порядке обработки)
+KEY_MOVES = ((KEY_UP, (0, -1)), (KEY_RIGHT, (1, 0)), (KEY_LEFT, (-1, 0)))
+
+# картинки игры: имя - файл
+IMAGES = {
+    'box': 'box.png',
+    'ground': 'ground.png',
+    'stones': 'stones.png',
+    'thorns': 'thorns.png',
+    'step': 'step.png',
+    'enemy': 'ghost.png',
+    'flag': 'flag.png',
+    'empty': 'empty.png',
+    'pause': 'pause.png',
+    'dark_fon': 'dark_fon.png',
+    'coins': 'coins.png',
+    'locked_level': 'locked_level.png',
+    'locked_level_pay': 'locked_level_pay.png',
+    'sound': 'sound.png',
+    'music': 'music.png',
+    'non_sound': 'non_sound.png',
+    'non_music': 'non_music.png',
+    'restart': 'restart.png',
+    'next': 'next.png'
+}
+
+# неподвижные тайлы карты, рисуются заранее собранными чанками
+STATIC_TILES = {
+    '#': 'ground',
+    '+': 'box',
+    '%': 'stones',
+    '-': 'step',
+    '^': 'thorns'
+}
+
 
 def load_image(name, color_key=None):
     fullname = 'data/' + name
@@ -40,6 +97,16 @@ def load_image(name, color_key=None):
         print('Cannot load image:', name)
         raise SystemExit(message)
 
+    # перевод в формат экрана (возможен только после set_mode),
+    # иначе формат пересчитывается при каждом выводе картинки
+    if pygame.display.get_surface():
+        w, h = image.get_size()
+        if pygame.mask.from_surface(image, 254).count() == w * h:
+            # полностью непрозрачной картинке альфа-канал не нужен
+            image = image.convert()
+        else:
+            image = image.convert_alpha()
+
     if color_key:
         if color_key is -1:
             color_key = image.get_at((0, 0))
@@ -47,39 +114,717 @@ def load_image(name, color_key=None):
     return image
 
 
-def load_level(number):
-    with open('data/levels.txt', 'r') as mapFile:
+class Assets:
+    # кэш картинок по имени файла и прозрачному цвету: каждая картинка
+    # читается с диска и переводится в формат экрана один раз,
+    # поэтому кэш создается после pygame.display.set_mode
+    def __init__(self):
+        self.images = dict()
+
+    def load(self, name, color_key=None):
+        key = (name, color_key)
+        if key not in self.images:
+            self.images[key] = load_image(name, color_key)
+        return self.images[key]
+
+
+class TextCache:
+    # шрифты по размеру и начертанию создаются один раз,
+    # готовые надписи хранятся в LRU-кэше: меню и счетчик монет
+    # каждый кадр выводят одни и те же строки
+    max_texts = 256
+
+    def __init__(self):
+        self.fonts = dict()
+        self.texts = OrderedDict()
+
+    def font(self, size, italic=False, u=False):
+        key = (size, italic, u)
+        if key not in self.fonts:
+            font = pygame.font.Font(None, size)
+            font.set_italic(italic)
+            font.set_underline(u)
+            self.fonts[key] = font
+        return self.fonts[key]
+
+    def render(self, text, size, color, italic=False, u=False):
+        key = (text, size, italic, u, tuple(color))
+        if key in self.texts:
+            self.texts.move_to_end(key)
+        else:
+            self.texts[key] = self.font(size, italic, u).render(text, 1, color)
+            if len(self.texts) > self.max_texts:
+                self.texts.popitem(last=False)
+        return self.texts[key]
+
+
+class Widgets:
+    # кнопки экрана: область (x1, y1, x2, y2) с краями включительно и значение.
+    # Области разложены по сетке cell x cell пикселей, поэтому поиск кнопки
+    # под мышью смотрит только кнопки своей клетки
+    cell = 100
+
+    def __init__(self):
+        self.items = []
+        self.grid = dict()
+        self.hover = None
+
+    def add(self, area, value):
+        if isinstance(area, pygame.Rect):
+            area = (area.x, area.y, area.x + area.w, area.y + area.h)
+        self.items.append((area, value))
+        for x in range(area[0] // self.cell, area[2] // self.cell + 1):
+            for y in range(area[1] // self.cell, area[3] // self.cell + 1):
+                self.grid.setdefault((x, y), []).append(len(self.items) - 1)
+
+    def update(self, widgets):
+        for area, value in widgets.items:
+            self.add(area, value)
+
+    def at(self, pos):
+        # номер верхней (добавленной последней) кнопки в точке pos или None
+        x, y = pos
+        for i in reversed(self.grid.get((x // self.cell, y // self.cell), ())):
+            area = self.items[i][0]
+            if area[0] <= x <= area[2] and area[1] <= y <= area[3]:
+                return i
+        return None
+
+    def value(self, i):
+        return self.items[i][1]
+
+    def move(self, pos):
+        # кнопка под мышью, True - если она сменилась
+        i = self.at(pos)
+        changed = i != self.hover
+        self.hover = i
+        return changed
+
+
+class Profiler:
+    # замер кадра по этапам: mark(name) записывает время, прошедшее
+    # с прошлой отметки. Последние window значений каждого этапа дают
+    # скользящие перцентили. При keep_frames все кадры (до max_frames)
+    # хранятся для выгрузки в csv/json: по массиву float на этап
+    window = 300
+    max_frames = 100000
+
+    def __init__(self, keep_frames=False):
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.samples = OrderedDict() if keep_frames else None
+        self.recorded = 0
+        self.frame = None
+        self.last = None
+
+    def begin(self):
+        self.frame = OrderedDict()
+        self.last = perf_counter()
+
+    def mark(self, name):
+        now = perf_counter()
+        self.frame[name] = self.frame.get(name, 0) + (now - self.last) * 1000
+        self.last = now
+
+    def count(self, name, value):
+        self.frame[name] = self.frame.get(name, 0) + value
+        self.counters[name] = None
+
+    def end(self):
+        frame = self.frame
+        frame["total"] = sum(value for name, value in frame.items() if name not in self.counters)
+        for name, value in frame.items():
+            if name not in self.phases:
+                self.phases[name] = deque(maxlen=self.window)
+            self.phases[name].append(value)
+        if self.samples is not None:
+            self.record(frame)
+        self.frame = None
+
+    def record(self, frame):
+        # этап, которого не было в прошлых кадрах, в них равен нулю
+        for name in frame:
+            if name not in self.samples:
+                self.samples[name] = array('f', bytes(4 * self.recorded))
+        for name, values in self.samples.items():
+            values.append(frame.get(name, 0))
+        self.recorded += 1
+        # лишние старые кадры отбрасываем пачкой, а не по одному за кадр
+        extra = self.recorded - self.max_frames
+        if extra >= self.max_frames // 10:
+            for values in self.samples.values():
+                del values[:extra]
+            self.recorded = self.max_frames
+
+    def percentile(self, name, q):
+        values = sorted(self.phases.get(name, ()))
+        if not values:
+            return 0
+        return values[min(int(len(values) * q / 100), len(values) - 1)]
+
+    def report(self):
+        # строки для экрана: этап, p50 и p99 (мс), для счетчиков - значения
+        lines = []
+        for name in self.phases:
+            unit = "" if name in self.counters else " ms"
+            lines.append("{:<8} p50 {:7.2f}  p99 {:7.2f}{}".format(
+                name, self.percentile(name, 50), self.percentile(name, 99), unit))
+        return lines
+
+    def export(self, path):
+        # по расширению файла: .json - список кадров, иначе csv.
+        # Последние max_frames кадров, счетчики - целыми числами
+        samples = self.samples or {}
+        names = list(samples)
+        start = max(self.recorded - self.max_frames, 0)
+        columns = [[int(value) for value in samples[name][start:]] if name in self.counters
+                   else [round(value, 3) for value in samples[name][start:]] for name in names]
+        frames = list(zip(*columns))
+        with open(path, 'w') as file:
+            if path.endswith('.json'):
+                file.write(dumps([dict(zip(names, frame)) for frame in frames]))
+            else:
+                file.write(",".join(["frame"] + names) + "\n")
+                for i, frame in enumerate(frames):
+                    file.write(",".join([str(i)] + ["{:.3f}".format(value) if type(value) is float else str(value)
+                                                    for value in frame]) + "\n")
+
+
+def new_progress():
+    # данные игры с нуля
+    return {
+        "levels": {
+            "1": 0,
+            "2": -1,
+            "3": -1,
+            "4": -1,
+            "5": -1,
+            "6": 100,
+            "7": 150,
+            "8": 200
+        },
+
+        "coins": 0,
+
+        "hero_colors": {
+            "classic_hero": "ok",
+            "red_hero": 50,
+            "blue_hero": 50,
+            "green_hero": 100,
+            "transparent_hero": 300
+        },
+
+        "sound": 1,
+        "music": 0
+    }
+
+
+# уровни в тексте и их собранный пакет
+LEVELS_FILE = 'data/levels.txt'
+LEVELS_PACK = 'data/levels.pack'
+# заголовок собранных файлов (пакета и индекса уровней): метка, версия, число уровней
+COMPILED_HEADER = struct.Struct('<4sHH')
+# запись индекса пакета: смещение, ширина, высота, клетка героя (x, y)
+PACK_ENTRY = struct.Struct('<IHHHH')
+PACK_MAGIC = b'NNLV'
+PACK_VERSION = 1
+
+
+class LevelMap:
+    # карта уровня: клетки хранятся по столбцам (столбец - height байт подряд),
+    # data - bytes или mmap пакета, offset - начало карты в нем
+    def __init__(self, data, width, height, offset=0, spawn=None):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.offset = offset
+        self.spawn = spawn
+
+    @staticmethod
+    def from_rows(rows):
+        # карта из списка строк, короткие строки дополняются пустотой
+        width = max(map(len, rows))
+        rows = [''.join(row).ljust(width) for row in rows]
+        data = bytes(ord(rows[y][x]) for x in range(width) for y in range(len(rows)))
+        spawn = None
+        for y, row in enumerate(rows):
+            if '@' in row:
+                spawn = (row.index('@'), y)
+        return LevelMap(data, width, len(rows), spawn=spawn)
+
+    def column(self, x):
+        start = self.offset + x * self.height
+        return self.data[start:start + self.height].decode('latin-1')
+
+    def cell(self, x, y):
+        return chr(self.data[self.offset + x * self.height + y])
+
+    # строки карты: level_map[y][x]
+    def __getitem__(self, y):
+        end = self.offset + self.width * self.height
+        return self.data[self.offset + y:end:self.height].decode('latin-1')
+
+    def __len__(self):
+        return self.height
+
+
+class LevelStream(LevelMap):
+    # карта, которая приходит кусками столбцов (например, от генератора
+    # уровней): chunks - байты подряд идущих столбцов. Куски дочитываются,
+    # когда к их столбцам впервые обращаются, поэтому играть можно,
+    # пока остальная карта еще готовится
+    def __init__(self, chunks, width, height, spawn):
+        super().__init__(bytearray(b' ' * (width * height)), width, height, spawn=spawn)
+        self.chunks = iter(chunks)
+        self.ready = 0
+
+    def fill(self, x):
+        # дочитываем столбцы до x включительно
+        while self.ready <= x:
+            chunk = next(self.chunks)
+            start = self.ready * self.height
+            self.data[start:start + len(chunk)] = chunk
+            self.ready += len(chunk) // self.height
+
+    def column(self, x):
+        self.fill(x)
+        return super().column(x)
+
+    def cell(self, x, y):
+        self.fill(x)
+        return super().cell(x, y)
+
+    def __getitem__(self, y):
+        self.fill(self.width - 1)
+        return super().__getitem__(y)
+
+
+def write_compiled(path, data):
+    # запись собранного файла через временный в той же папке: другой процесс
+    # может держать старый файл отображенным в память, поэтому старый
+    # не переписывается на месте, а целиком заменяется новым
+    handle, temp = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            file.write(data)
+        os.replace(temp, path)
+    except OSError:
+        os.remove(temp)
+        raise
+
+
+def open_compiled(src, path, build, cls):
+    # собранный файл path, отображенный в память (cls - его класс):
+    # пересобираем его build(src), если его нет или src изменился
+    try:
+        if os.path.getmtime(path) >= os.path.getmtime(src):
+            with open(path, 'rb') as file:
+                compiled = cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+            return compiled
+    except (OSError, ValueError, struct.error):
+        pass
+    data = build(src)
+    try:
+        write_compiled(path, data)
+    except OSError:
+        # нет прав на запись - работаем с собранным файлом в памяти
+        pass
+    return cls(data)
+
+
+def build_level_pack(src=LEVELS_FILE):
+    # разбираем levels.txt один раз и собираем пакет уровней
+    with open(src, 'r') as mapFile:
         mapFile = "\n".join(list(line.strip() for line in mapFile)).strip()
-        mapFile = [[j for j in i] for i in mapFile.split("level")[number].strip().split('\n')]
-    return mapFile
+    levels = [LevelMap.from_rows(level.strip().split('\n')) for level in mapFile.split("level")[1:]]
+
+    index = []
+    offset = COMPILED_HEADER.size + PACK_ENTRY.size * len(levels)
+    for level in levels:
+        spawn = level.spawn or (0, 0)
+        index.append(PACK_ENTRY.pack(offset, level.width, level.height, *spawn))
+        offset += len(level.data)
+    return b''.join([COMPILED_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(levels))] + index +
+                    [level.data for level in levels])
+
+
+class LevelPack:
+    # собранные уровни, файл отображается в память: при загрузке уровня
+    # читается только его индекс и его карта
+    def __init__(self, data):
+        self.data = data
+        magic, version, count = COMPILED_HEADER.unpack_from(data)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            raise ValueError('wrong level pack')
+        self.count = count
+
+    @staticmethod
+    def open(src=LEVELS_FILE, path=LEVELS_PACK):
+        # пересобираем пакет, если его нет или levels.txt изменился
+        return open_compiled(src, path, build_level_pack, LevelPack)
+
+    def level(self, number):
+        if not 1 <= number <= self.count:
+            raise IndexError('no level {}'.format(number))
+        offset, width, height, x, y = PACK_ENTRY.unpack_from(
+            self.data, COMPILED_HEADER.size + PACK_ENTRY.size * (number - 1))
+        return LevelMap(self.data, width, height, offset, (x, y))
+
+
+level_pack = None
+
+
+def load_level(number):
+    global level_pack
+    if level_pack is None:
+        level_pack = LevelPack.open()
+    return level_pack.level(number)
+
+
+LEVELS_INDEX = 'data/levels.index'
+# заголовок - COMPILED_HEADER; запись: смещение, ширина, высота, число групп монет;
+# группа монет: первая клетка (x, y), монет в ней, из них достижимых
+INDEX_ENTRY = struct.Struct('<IHHH')
+INDEX_CLUSTER = struct.Struct('<HHHH')
+INDEX_MAGIC = b'NNIX'
+INDEX_VERSION = 2
+
+# твердые клетки карты, сквозь них герой не проходит; ступенька '-' -
+# узкая полка вверху клетки: клетку можно пройти, а на ступеньке стоять
+SOLID_CELLS = '#+%^'
+SUPPORT_CELLS = '#+%^-'
+# флаги клеток в индексе: герой может сюда попасть, рядом есть такая клетка,
+# враг отсюда ходит рядом с клетками героя
+CELL_REACHABLE = 1
+CELL_NEAR = 2
+CELL_ENEMY_ACTIVE = 4
+# до флага не дойти
+FAR = 0xffff
+
+
+class ReachMap:
+    # заранее посчитанные сведения об уровне: куда может попасть герой,
+    # группы монет, близость опасностей и расстояние до флага.
+    # Поля хранятся по столбцам, как клетки LevelMap (data - bytes или mmap):
+    # флаги CELL_* по байту на клетку, расстояние до шипов и дорожек врагов
+    # в клетках (не больше 255) по байту, ходов до флага по два байта.
+    # Движение героя считается по клеткам и с запасом: прыжок на jump
+    # клеток вверх, в воздухе клетка вбок на каждую клетку вверх или вниз,
+    # после схода с края можно прыгнуть (как в Player.move). Над картой
+    # пусто: герой выпрыгивает за верхний ряд и ходит поверх стен. Точный
+    # путь по пикселям ищет level_validator.py
+    jump = 2
+
+    def __init__(self, data, width, height, offset=0, clusters=()):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.offset = offset
+        self.clusters = clusters
+
+    def flags(self, x, y):
+        return self.data[self.offset + x * self.height + y]
+
+    def reachable(self, x, y):
+        return bool(self.flags(x, y) & CELL_REACHABLE)
+
+    def enemy_active(self, x, y):
+        # враг из клетки (x, y) когда-нибудь окажется рядом с героем
+        return bool(self.flags(x, y) & CELL_ENEMY_ACTIVE)
+
+    def hazard(self, x, y):
+        return self.data[self.offset + (self.width + x) * self.height + y]
+
+    def flag_distance(self, x, y):
+        return struct.unpack_from('<H', self.data, self.offset + 2 * (self.width * self.height +
+                                                                      x * self.height + y))[0]
+
+    def summary(self, level_map):
+        # итог для дизайнера уровней
+        spawn = self.flag_distance(*level_map.spawn)
+        return {
+            "reachable_cells": sum(self.reachable(x, y) for x in range(self.width) for y in range(self.height)),
+            "flag_moves": None if spawn == FAR else spawn,
+            "coin_clusters": [{"x": x, "y": y, "coins": coins, "reachable": reachable}
+                              for x, y, coins, reachable in self.clusters],
+            "unreachable_coins": sum(coins - reachable for x, y, coins, reachable in self.clusters),
+            "idle_enemies": sum(1 for x in range(self.width) for y in range(self.height)
+                                if level_map.cell(x, y) == '*' and not self.enemy_active(x, y))
+        }
+
+    @staticmethod
+    def build(level_map):
+        width, height = level_map.width, level_map.height
+        columns = [level_map.column(x) for x in range(width)]
+        jump = ReachMap.jump
+
+        # над картой (y < 0) пусто, выше прыжка со стен у верхнего ряда не подняться
+        def free(x, y):
+            return (0 <= x < width and -1 - jump <= y < height and
+                    (y < 0 or columns[x][y] not in SOLID_CELLS))
+
+        def ground(x, y):
+            return 0 <= y + 1 < height and columns[x][y + 1] in SUPPORT_CELLS
+
+        def norm(x, y, rise, drift):
+            # на земле прыжок и ход вбок снова доступны
+            return (x, y, jump, 1) if ground(x, y) else (x, y, rise, drift)
+
+        def moves(state):
+            x, y, rise, drift = state
+            on_ground = ground(x, y)
+            for nx in (x - 1, x + 1):
+                if free(nx, y) and (on_ground or drift):
+                    yield norm(nx, y, rise, 0)
+            if rise and free(x, y - 1):
+                yield norm(x, y - 1, rise - 1, 1)
+            if not on_ground and free(x, y + 1):
+                # сошедший с края герой еще может прыгнуть
+                yield norm(x, y + 1, jump if rise == jump else 0, 1)
+
+        # обход в ширину состояний героя от клетки @, с обратными ходами
+        first = norm(*level_map.spawn, jump, 1)
+        back = {first: []}
+        queue = deque([first])
+        while queue:
+            state = queue.popleft()
+            for new in moves(state):
+                if new not in back:
+                    back[new] = []
+                    queue.append(new)
+                back[new].append(state)
+
+        # в индексе только клетки карты; столбцы, где герой бывает
+        # сразу над картой, делают соседние клетки верхнего ряда близкими
+        flags = bytearray(width * height)
+        above = set()
+        for x, y, rise, drift in back:
+            if y >= 0:
+                flags[x * height + y] |= CELL_REACHABLE
+            elif y == -1:
+                above.add(x)
+        for x in range(width):
+            for y in range(height):
+                if any(flags[nx * height + ny] & CELL_REACHABLE
+                       for nx in range(max(x - 1, 0), min(x + 2, width))
+                       for ny in range(max(y - 1, 0), min(y + 2, height))) or \
+                        y == 0 and any(nx in above for nx in range(x - 1, x + 2)):
+                    flags[x * height + y] |= CELL_NEAR
+
+        # ходов до флага: обход назад от всех состояний в клетках флага
+        moves_to_flag = {state: 0 for state in back if state[1] >= 0 and columns[state[0]][state[1]] == '&'}
+        queue = deque(moves_to_flag)
+        while queue:
+            state = queue.popleft()
+            for prev in back[state]:
+                if prev not in moves_to_flag:
+                    moves_to_flag[prev] = moves_to_flag[state] + 1
+                    queue.append(prev)
+        distance = [FAR] * (width * height)
+        for (x, y, rise, drift), count in moves_to_flag.items():
+            if y >= 0:
+                distance[x * height + y] = min(distance[x * height + y], count)
+
+        # опасности: шипы и дорожки врагов (враг ходит по своей опоре до края или стены)
+        sources = []
+        for x in range(width):
+            for y in range(height):
+                if columns[x][y] == '^':
+                    sources.append((x, y))
+                elif columns[x][y] == '*':
+                    path = [x]
+                    for step in (-1, 1):
+                        nx = x + step
+                        while ground(x, y) and free(nx, y) and ground(nx, y):
+                            path.append(nx)
+                            nx += step
+                    sources.extend((nx, y) for nx in path)
+                    if any(flags[nx * height + y] & CELL_NEAR for nx in path):
+                        flags[x * height + y] |= CELL_ENEMY_ACTIVE
+        hazard = bytearray([255]) * (width * height)
+        for x, y in sources:
+            hazard[x * height + y] = 0
+        queue = deque(sources)
+        while queue:
+            x, y = queue.popleft()
+            near = hazard[x * height + y] + 1
+            if near >= 255:
+                continue
+            for nx in range(max(x - 1, 0), min(x + 2, width)):
+                for ny in range(max(y - 1, 0), min(y + 2, height)):
+                    if hazard[nx * height + ny] > near:
+                        hazard[nx * height + ny] = near
+                        queue.append((nx, ny))
+
+        # группы соседних (и по диагонали) монет
+        clusters = []
+        seen = set()
+        for x in range(width):
+            for y in range(height):
+                if columns[x][y] != '$' or (x, y) in seen:
+                    continue
+                seen.add((x, y))
+                group = [(x, y)]
+                for cx, cy in group:
+                    for nx in range(max(cx - 1, 0), min(cx + 2, width)):
+                        for ny in range(max(cy - 1, 0), min(cy + 2, height)):
+                            if columns[nx][ny] == '$' and (nx, ny) not in seen:
+                                seen.add((nx, ny))
+                                group.append((nx, ny))
+                clusters.append((x, y, len(group),
+                                 sum(1 for cx, cy in group if flags[cx * height + cy] & CELL_REACHABLE)))
+
+        data = bytes(flags) + bytes(hazard) + struct.pack('<{}H'.format(len(distance)), *distance)
+        return ReachMap(data, width, height, clusters=tuple(clusters))
+
+
+def build_level_index(src=LEVELS_FILE):
+    # индекс всех уровней из levels.txt, собирается один раз рядом с пакетом
+    pack = LevelPack(build_level_pack(src))
+    reach_maps = [ReachMap.build(pack.level(number)) for number in range(1, pack.count + 1)]
+
+    index = []
+    offset = COMPILED_HEADER.size + INDEX_ENTRY.size * len(reach_maps)
+    for reach in reach_maps:
+        index.append(INDEX_ENTRY.pack(offset, reach.width, reach.height, len(reach.clusters)))
+        offset += len(reach.data) + INDEX_CLUSTER.size * len(reach.clusters)
+    parts = [COMPILED_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(reach_maps))] + index
+    for reach in reach_maps:
+        parts.append(reach.data)
+        parts.extend(INDEX_CLUSTER.pack(*cluster) for cluster in reach.clusters)
+    return b''.join(parts)
+
+
+class LevelIndex:
+    # собранный индекс уровней, как и пакет, отображается в память
+    def __init__(self, data):
+        self.data = data
+        magic, version, count = COMPILED_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError('wrong level index')
+        self.count = count
+
+    @staticmethod
+    def open(src=LEVELS_FILE, path=LEVELS_INDEX):
+        # пересобираем индекс, если его нет или levels.txt изменился
+        return open_compiled(src, path, build_level_index, LevelIndex)
+
+    def level(self, number):
+        if not 1 <= number <= self.count:
+            raise IndexError('no level {}'.format(number))
+        offset, width, height, count = INDEX_ENTRY.unpack_from(
+            self.data, COMPILED_HEADER.size + INDEX_ENTRY.size * (number - 1))
+        start = offset + 4 * width * height
+        clusters = tuple(INDEX_CLUSTER.unpack_from(self.data, start + INDEX_CLUSTER.size * i)
+                         for i in range(count))
+        return ReachMap(self.data, width, height, offset, clusters)
+
+
+level_index = None
+
+
+def load_reach(number):
+    global level_index
+    if level_index is None:
+        level_index = LevelIndex.open()
+    return level_index.level(number)
+
+
+class TileGrid(pygame.sprite.Group):
+    # группа неподвижных спрайтов с равномерной сеткой:
+    # поиск столкновений проверяет только клетки, которые перекрывает спрайт
+    def __init__(self, game):
+        super().__init__()
+        self.cell_w = game.tile_width
+        self.cell_h = game.tile_height
+        self.cells = dict()
+        # число запросов, его читает и сбрасывает профайлер
+        self.queries = 0
+
+    def cells_of(self, rect):
+        x1 = rect.left // self.cell_w
+        x2 = (rect.right - 1) // self.cell_w
+        y1 = rect.top // self.cell_h
+        y2 = (rect.bottom - 1) // self.cell_h
+        return [(x, y) for y in range(y1, y2 + 1) for x in range(x1, x2 + 1)]
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite)
+        for cell in self.cells_of(sprite.rect):
+            self.cells.setdefault(cell, []).append(sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        for cell in self.cells_of(sprite.rect):
+            self.cells[cell].remove(sprite)
+            # пустые клетки убираем, иначе при подгрузке карты словарь растет
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    def query(self, rect):
+        # спрайты из клеток (от 1 до 4 для героя), которые перекрывает rect
+        self.queries += 1
+        found = dict()
+        for cell in self.cells_of(rect):
+            for sprite in self.cells.get(cell, ()):
+                found[sprite] = None
+        return list(found)
+
+    def spritecollide(self, sprite):
+        # то же, что и pygame.sprite.spritecollide(sprite, self, False)
+        return [s for s in self.query(sprite.rect) if sprite.rect.colliderect(s.rect)]
 
 
 class Tile(pygame.sprite.Sprite):
     name = "tile"
+    # маски общие для всех тайлов одного типа
+    masks = dict()
+    # непрозрачная часть тайла, если маска целиком заполняет прямоугольник
+    solid_rects = dict()
+    solid = None
 
     def __init__(self, game, tile_type, pos_x, pos_y, *groups, name=None):
-        super().__init__(game.all_sprites, *groups)
+        # rect задаем до добавления в группы, по нему TileGrid находит клетку
         self.image = game.images[tile_type]
         self.rect = self.image.get_rect().move(game.tile_width * pos_x,
                                                game.tile_height * pos_y)
-        self.mask = pygame.mask.from_surface(self.image)
+        super().__init__(*groups)
+        if tile_type not in Tile.masks:
+            Tile.add_type(tile_type, self.image)
+        self.mask = Tile.masks[tile_type]
+        if Tile.solid_rects[tile_type]:
+            # с такими тайлами столкновения считаются без масок
+            self.solid = Tile.solid_rects[tile_type].move(self.rect.topleft)
         if name:
             self.name = name
 
+    @staticmethod
+    def add_type(tile_type, image):
+        mask = pygame.mask.from_surface(image)
+        bounds = mask.get_bounding_rects()
+        if len(bounds) == 1 and mask.count() == bounds[0].w * bounds[0].h:
+            Tile.solid_rects[tile_type] = bounds[0]
+        else:
+            Tile.solid_rects[tile_type] = None
+        Tile.masks[tile_type] = mask
+
 
 class Enemy(pygame.sprite.Sprite):
     name = "enemy"
 
     def __init__(self, game, pos_x, pos_y):
-        super().__init__(game.all_sprites, game.danger_group)
+        super().__init__(game.enemy_group)
         self.image = game.images["enemy"]
         self.rect = self.image.get_rect().move(game.tile_width * pos_x,
                                                game.tile_height * pos_y)
+        # положение на прошлом шаге, для плавной отрисовки между шагами
+        self.prev = self.rect.topleft
         self.game = game
         self.direction = 1
 
     def update(self, *args):
-        if pygame.sprite.spritecollide(self, self.game.block_group, False):
+        self.prev = self.rect.topleft
+        if self.game.block_group.spritecollide(self):
             # при столкновении с блоком разворот
             self.direction *= -1
         else:
@@ -88,7 +833,7 @@ class Enemy(pygame.sprite.Sprite):
                 t = (self.rect.w - i) * self.direction
                 self.rect.y += 10
                 self.rect.x += t
-                if not pygame.sprite.spritecollide(self, self.game.block_group, False):
+                if not self.game.block_group.spritecollide(self):
                     self.direction *= -1
                 self.rect.y -= 10
                 self.rect.x -= t
@@ -96,51 +841,156 @@ class Enemy(pygame.sprite.Sprite):
         self.rect.x += self.direction * 4
 
 
+class EnemyGroup(pygame.sprite.Group):
+    # все враги уровня обновляются разом: положения и направления хранятся
+    # в массивах numpy, стены и пустоты под ними проверяются по сетке
+    # твердых клеток карты (та же проверка, что в Enemy.update, для всех сразу)
+    def __init__(self, game):
+        super().__init__()
+        self.game = game
+        level_map = game.level_map
+        self.cell_w = game.tile_width
+        self.cell_h = game.tile_height
+        # клетки карты по столбцам прямо из ее данных, без копирования
+        self.cells = numpy.frombuffer(level_map.data, numpy.uint8, level_map.width * level_map.height,
+                                      level_map.offset).reshape(level_map.width, level_map.height)
+        self.solid = numpy.zeros(256, bool)
+        self.solid[list(b'#+%^-')] = True
+        # массивы строятся заново, когда враги добавляются или выгружаются
+        self.order = None
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite)
+        self.reset()
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        self.reset()
+
+    def reset(self):
+        # возвращаем врагам их направления, массивы соберутся при обновлении
+        if self.order is not None:
+            for enemy, direction in zip(self.order, self.direction.tolist()):
+                enemy.direction = direction
+            self.order = None
+
+    def build(self):
+        self.order = self.sprites()
+        self.x = numpy.array([enemy.rect.x for enemy in self.order], int)
+        self.y = numpy.array([enemy.rect.y for enemy in self.order], int)
+        self.direction = numpy.array([enemy.direction for enemy in self.order], int)
+        if self.order:
+            self.w, self.h = self.order[0].rect.size
+
+    def collide(self, x, y):
+        # True для тех прямоугольников (x, y, w, h), что задевают твердую клетку
+        hit = numpy.zeros(len(x), bool)
+        x1 = x // self.cell_w
+        x2 = (x + self.w - 1) // self.cell_w
+        y1 = y // self.cell_h
+        y2 = (y + self.h - 1) // self.cell_h
+        width, height = self.cells.shape
+        for i in range((self.w - 1) // self.cell_w + 2):
+            for j in range((self.h - 1) // self.cell_h + 2):
+                cx = x1 + i
+                cy = y1 + j
+                inside = (cx <= x2) & (cy <= y2) & (cx >= 0) & (cx < width) & (cy >= 0) & (cy < height)
+                hit[inside] |= self.solid[self.cells[cx[inside], cy[inside]]]
+        return hit
+
+    def update(self, *args):
+        if self.order is None:
+            self.build()
+        if not self.order:
+            return
+        x, y, direction = self.x, self.y, self.direction
+        # при столкновении с блоком разворот
+        wall = self.collide(x, y)
+        direction[wall] *= -1
+        # иначе проверка на пустоту под ним, по очереди, как в Enemy.update
+        for i in range(4):
+            empty = ~wall & ~self.collide(x + (self.w - i) * direction, y + 10)
+            direction[empty] *= -1
+        # движение на 4 пикселя
+        x += direction * 4
+        for enemy, new_x in zip(self.order, x.tolist()):
+            enemy.prev = enemy.rect.topleft
+            enemy.rect.x = new_x
+
+
 class Coin(pygame.sprite.Sprite):
     name = "coin"
+    # кадры анимации нарезаются один раз и общие для всех монет
+    frames = []
+    # монета всегда сталкивалась по маске первого кадра, она тоже общая
+    mask = None
+    # общий для всех монет номер кадра, поэтому монеты не обновляются по одной
+    cur_frame = 0
 
     def __init__(self, game, x, y):
-        super().__init__(game.all_sprites)
-        self.frames = []
-        self.cut_sheet(load_image("coins_animate.png"))
-        self.cur_frame = 0
-        self.image = self.frames[self.cur_frame]
-        self.rect = self.rect.move(x * game.tile_width + (game.tile_width - self.rect.w) // 2,
-                                   y * game.tile_height + game.tile_height - self.rect.h)
-        self.mask = pygame.mask.from_surface(self.image)
-
-    def cut_sheet(self, sheet):
-        self.rect = pygame.Rect(0, 0, sheet.get_width() // 8, sheet.get_height() // 3)
+        if not Coin.frames:
+            Coin.cut_sheet(game.assets.load("coins_animate.png"))
+        w, h = Coin.frames[0].get_size()
+        self.rect = pygame.Rect(x * game.tile_width + (game.tile_width - w) // 2,
+                                y * game.tile_height + game.tile_height - h, w, h)
+        # клетка карты, чтобы помнить собранные монеты
+        self.cell = (x, y)
+        super().__init__(game.pickup_group)
+
+    @staticmethod
+    def cut_sheet(sheet):
+        rect = pygame.Rect(0, 0, sheet.get_width() // 8, sheet.get_height() // 3)
         for j in range(3):
             for i in range(8):
-                frame_location = (self.rect.w * i, self.rect.h * j)
-                self.frames.append(sheet.subsurface(pygame.Rect(frame_location, self.rect.size)))
+                frame_location = (rect.w * i, rect.h * j)
+                Coin.frames.append(sheet.subsurface(pygame.Rect(frame_location, rect.size)))
+        Coin.mask = pygame.mask.from_surface(Coin.frames[0])
 
-    def update(self, *args):
-        # анимация
-        self.cur_frame = (self.cur_frame + 1) % len(self.frames)
-        self.image = self.frames[self.cur_frame]
+    @staticmethod
+    def animate():
+        # анимация всех монет сразу
+        Coin.cur_frame = (Coin.cur_frame + 1) % len(Coin.frames)
+
+    @property
+    def image(self):
+        return Coin.frames[Coin.cur_frame]
 
 
 class Player(pygame.sprite.Sprite):
     name = "player"
 
     def __init__(self, game, x, y):
-        super().__init__(game.all_sprites)
+        # герой обновляется отдельно, после остальных спрайтов
+        super().__init__()
         self.game = game
         self.frames1 = []
         self.frames2 = []
         hero = list(filter(lambda h: self.game.data["hero_colors"][h] == "ok", self.game.data["hero_colors"]))[0]
         if hero == "transparent_hero":
-            self.cut_sheets(load_image('heroes/{}R.png'.format(hero), color_key=(0, 0, 0, 0)),
-                            load_image('heroes/{}L.png'.format(hero), color_key=(0, 0, 0, 0)))
+            self.cut_sheets(game.assets.load('heroes/{}R.png'.format(hero), color_key=(0, 0, 0, 0)),
+                            game.assets.load('heroes/{}L.png'.format(hero), color_key=(0, 0, 0, 0)))
         else:
-            self.cut_sheets(load_image('heroes/{}R.png'.format(hero)),
-                            load_image('heroes/{}L.png'.format(hero)))
+            self.cut_sheets(game.assets.load('heroes/{}R.png'.format(hero)),
+                            game.assets.load('heroes/{}L.png'.format(hero)))
         self.cur_frame = 0
         self.image = self.frames1[self.cur_frame]
         self.rect = self.rect.move(x + (game.tile_width - self.rect.w) // 2, y)
+        self.prev = self.rect.topleft
         self.mask = pygame.mask.from_surface(self.image)
+        # крайние точки маски в каждой строке и каждом столбце,
+        # по ним считаются столкновения с непрозрачными тайлами
+        self.mask_left = []
+        self.mask_right = []
+        for j in range(self.rect.h):
+            row = [i for i in range(self.rect.w) if self.mask.get_at((i, j))]
+            self.mask_left.append(row[0] if row else self.rect.w)
+            self.mask_right.append(row[-1] if row else -1)
+        self.mask_top = []
+        self.mask_bottom = []
+        for i in range(self.rect.w):
+            column = [j for j in range(self.rect.h) if self.mask.get_at((i, j))]
+            self.mask_top.append(column[0] if column else self.rect.h)
+            self.mask_bottom.append(column[-1] if column else -1)
         self.moving_y = (0, 0)
         self.jumping = False
         self.moving_x = (0, 0)
@@ -174,23 +1024,114 @@ class Player(pygame.sprite.Sprite):
         if y and not self.jumping:
             self.moving_y = [y, 120]
 
+    def collide_sprites(self, group):
+        # неподвижные тайлы ищем по сетке, остальные спрайты - перебором
+        if isinstance(group, TileGrid):
+            return group.spritecollide(self)
+        return pygame.sprite.spritecollide(self, group, False)
+
+    def collide_solid(self, rect):
+        # пересечение маски героя с полностью непрозрачным прямоугольником
+        clip = self.rect.clip(rect)
+        if not clip.w or not clip.h:
+            return False
+        x1, x2 = clip.left - self.rect.x, clip.right - self.rect.x
+        y1, y2 = clip.top - self.rect.y, clip.bottom - self.rect.y
+        if x1 == 0:
+            # прямоугольник захватывает левый край героя
+            return min(self.mask_left[y1:y2]) < x2
+        if x2 == self.rect.w:
+            # правый край
+            return max(self.mask_right[y1:y2]) >= x1
+        # прямоугольник уже героя
+        return self.mask.overlap(pygame.mask.Mask(clip.size, fill=True), (x1, y1)) is not None
+
+    def solid_distance(self, solid, dx, dy):
+        # номер шага при движении на (dx, dy), на котором маска героя впервые
+        # заденет непрозрачный прямоугольник solid; 0 - не заденет никогда,
+        # None - посчитать сразу нельзя (герой уже рядом или внутри)
+        r = self.rect
+        if dx:
+            y1, y2 = max(solid.top - r.top, 0), min(solid.bottom - r.top, r.h)
+            # в этих строках у героя нет ни одной точки
+            if y1 >= y2 or min(self.mask_left[y1:y2]) == r.w:
+                return 0
+            if dx > 0:
+                k = solid.left - r.x - max(self.mask_right[y1:y2])
+                if min(self.mask_left[y1:y2]) >= solid.right - r.x - 1:
+                    return 0
+            else:
+                k = r.x + min(self.mask_left[y1:y2]) - solid.right + 1
+                if max(self.mask_right[y1:y2]) < solid.left - r.x + 1:
+                    return 0
+        else:
+            x1, x2 = max(solid.left - r.left, 0), min(solid.right - r.left, r.w)
+            if x1 >= x2 or min(self.mask_top[x1:x2]) == r.h:
+                return 0
+            if dy > 0:
+                k = solid.top - r.y - max(self.mask_bottom[x1:x2])
+                if min(self.mask_top[x1:x2]) >= solid.bottom - r.y - 1:
+                    return 0
+            else:
+                k = r.y + min(self.mask_top[x1:x2]) - solid.bottom + 1
+                if max(self.mask_bottom[x1:x2]) < solid.top - r.y + 1:
+                    return 0
+        return k if k >= 1 else None
+
+    def contact_step(self, sprite, dx, dy, steps):
+        # первый шаг от 1 до steps, на котором герой столкнется с блоком sprite, или 0
+        if sprite.solid:
+            k = self.solid_distance(sprite.solid, dx, dy)
+            if k is not None:
+                return k if k <= steps else 0
+        # шипы (и редкие случаи вплотную к тайлу) проверяем по пикселям,
+        # но только с одним этим тайлом
+        rect = self.rect
+        for k in range(1, steps + 1):
+            self.rect = rect.move(dx * k, dy * k)
+            if self.collide_solid(sprite.solid) if sprite.solid else pygame.sprite.collide_mask(self, sprite):
+                break
+        else:
+            k = 0
+        self.rect = rect
+        return k
+
+    def sweep(self, dx, dy, steps):
+        # движение на steps пикселей по (dx, dy) за один запрос к сетке:
+        # возвращает шаг, на котором герой упрется в блок, или 0
+        path = self.rect.union(self.rect.move(dx * steps, dy * steps))
+        found = 0
+        for sprite in self.game.block_group.query(path):
+            if sprite.rect.colliderect(path):
+                k = self.contact_step(sprite, dx, dy, steps)
+                if k:
+                    # дальше ближайшего столкновения проверять незачем
+                    found = k
+                    steps = k - 1
+        return found
+
     def check_collides(self, group, check_win=False):
         if check_win:
-            # проверка на выигрыш, столкновение с флагом или монетой
-            for sprite in pygame.sprite.spritecollide(self, group, False):
+            # проверка на выигрыш, столкновение с флагом или монетой;
+            # флаг и монеты проверяем в порядке карты (по строкам)
+            found = sorted(self.collide_sprites(group),
+                           key=lambda s: (s.rect.y // self.game.tile_height, s.rect.x // self.game.tile_width))
+            for sprite in found:
                 if pygame.sprite.collide_mask(self, sprite):
                     if sprite.name == "flag":
                         return True
                     elif sprite.name == "coin":  # сбор монет
-                        coins = choice(range(2, 6))
+                        coins = self.game.random.choice(range(2, 6))
                         self.game.got_coins += coins
                         self.game.data["coins"] += coins
+                        self.game.taken.add(sprite.cell)
                         sprite.kill()
             return False
         else:
             # проверка на столкновение с заданной группой
-            for sprite in pygame.sprite.spritecollide(self, group, False):
-                if pygame.sprite.collide_mask(self, sprite):
+            for sprite in self.collide_sprites(group):
+                solid = getattr(sprite, "solid", None)
+                if self.collide_solid(solid) if solid else pygame.sprite.collide_mask(self, sprite):
                     # заодно на столкновение с жизнеотнимателями
                     if sprite.name in ("enemy", "thorns") and not self.blink:
                         if not self.take_life:  # защита от лишней потери жизней
@@ -204,9 +1145,10 @@ class Player(pygame.sprite.Sprite):
             return False
 
     def update(self, *args):
+        self.prev = self.rect.topleft
         self.take_life = False  # отнимать жизни можно опять
 
-        if self.check_collides(self.game.all_sprites, check_win=True) and not self.blink:
+        if self.check_collides(self.game.pickup_group, check_win=True) and not self.blink:
             self.game.victory = True
             return True
 
@@ -216,60 +1158,182 @@ class Player(pygame.sprite.Sprite):
             if self.blink % 4 == 0:
                 self.image = self.game.images['empty'] if self.blink % 8 else self.frames1[self.cur_frame]
         else:
-            # иначе проверяем на столкновение с передвигающимися врагами
-            self.check_collides(self.game.danger_group)
-
-        # ход по горизонтали
-        i = 0
-        for i in range(int(self.moving_x[1] * (1.5 if self.jumping else 1))):
-            self.rect.x += self.moving_x[0]
-            if self.check_collides(self.game.block_group):
+            # иначе проверяем на столкновение с шипами и передвигающимися врагами
+            if not self.check_collides(self.game.danger_group):
+                self.check_collides(self.game.enemy_group)
+
+        # ход по горизонтали: сразу на весь путь до первого препятствия
+        steps = int(self.moving_x[1] * (1.5 if self.jumping else 1))
+        if steps:
+            k = self.sweep(self.moving_x[0], 0, steps)
+            if k:
+                # у препятствия заодно проверяем столкновение с шипами
+                self.rect.x += self.moving_x[0] * k
+                self.check_collides(self.game.block_group)
                 self.rect.x -= self.moving_x[0]
                 self.moving_x = [0, 0]
-                break
-        if i:
-            self.next_pic(self.moving_x[0])
+            else:
+                self.rect.x += self.moving_x[0] * steps
+                if steps > 1:
+                    self.next_pic(self.moving_x[0])
 
         # движение фона
-        for pic in self.game.game_fon:
-            pic.rect.x -= self.moving_x[0] * 2
+        self.game.fon_offset[0] -= self.moving_x[0] * 2
         self.moving_x = [0, 0]
 
         # движение по вертикали
         if self.moving_y[1] > 0:
-            for i in range(10):
-                self.rect.y += self.moving_y[0]
-                if self.check_collides(self.game.block_group):
-                    self.rect.y -= self.moving_y[0]
-                    self.moving_y = [0, 0]
-                    return False
+            k = self.sweep(0, self.moving_y[0], 10)
+            if k:
+                self.rect.y += self.moving_y[0] * k
+                self.check_collides(self.game.block_group)
+                self.rect.y -= self.moving_y[0]
+                self.moving_y = [0, 0]
+                return False
+            self.rect.y += self.moving_y[0] * 10
             self.jumping = True
             self.moving_y[1] -= 8
-            for pic in self.game.game_fon:
-                pic.rect.y += 3
+            self.game.fon_offset[1] += 3
         else:  # падение
-            for i in range(10):
-                self.rect.y += 1
-                if self.check_collides(self.game.block_group):
-                    self.rect.y -= 1
-                    self.jumping = False
-                    return False
-            for pic in self.game.game_fon:
-                pic.rect.y -= 3
+            k = self.sweep(0, 1, 10)
+            if k:
+                self.rect.y += k
+                self.check_collides(self.game.block_group)
+                self.rect.y -= 1
+                self.jumping = False
+                return False
+            self.rect.y += 10
+            self.game.fon_offset[1] -= 3
 
 
 class MySprite(pygame.sprite.Sprite):
     name = "other"
 
     def __init__(self, game, img, x, y, abs_coords=False):
-        super().__init__(game.all_sprites)
-        self.image = load_image(img) if type(img) == str else img
+        super().__init__()
+        self.image = game.assets.load(img) if type(img) == str else img
         if abs_coords:
             self.rect = self.image.get_rect().move(x, y)
         else:
             self.rect = self.image.get_rect().move(x * game.tile_width, y * game.tile_height)
 
 
+def interpolate(sprite, alpha):
+    # положение подвижного спрайта между двумя шагами физики
+    x, y = sprite.prev
+    return (round(x + (sprite.rect.x - x) * alpha),
+            round(y + (sprite.rect.y - y) * alpha))
+
+
+class ChunkCache:
+    # неподвижные тайлы собираются в большие поверхности по 16x10 клеток.
+    # Чанк строится при первом попадании в кадр, давно не видимые
+    # чанки вытесняются (LRU), чтобы память не росла на больших картах
+    chunk_w = 16
+    chunk_h = 10
+    max_chunks = 8
+
+    def __init__(self, game):
+        self.level_map = game.level_map
+        self.images = game.images
+        self.tile_width = game.tile_width
+        self.tile_height = game.tile_height
+        self.width = self.chunk_w * game.tile_width
+        self.height = self.chunk_h * game.tile_height
+        self.chunks = OrderedDict()
+
+    def build(self, cx, cy):
+        surface = None
+        for x in range(cx * self.chunk_w, min((cx + 1) * self.chunk_w, self.level_map.width)):
+            column = self.level_map.column(x)
+            for y in range(cy * self.chunk_h, min((cy + 1) * self.chunk_h, self.level_map.height)):
+                if column[y] in STATIC_TILES:
+                    if surface is None:
+                        surface = pygame.Surface((self.width, self.height), pygame.SRCALPHA)
+                    surface.blit(self.images[STATIC_TILES[column[y]]],
+                                 ((x % self.chunk_w) * self.tile_width,
+                                  (y % self.chunk_h) * self.tile_height))
+        # пустые чанки не рисуем вовсе
+        return surface.convert_alpha() if surface else None
+
+    def get(self, cx, cy):
+        key = (cx, cy)
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+        else:
+            self.chunks[key] = self.build(cx, cy)
+            if len(self.chunks) > self.max_chunks:
+                self.chunks.popitem(last=False)
+        return self.chunks[key]
+
+    def visible(self, view, dx, dy):
+        # чанки, попавшие в view, и их положение на экране
+        blits = []
+        for cy in range(max(view.top, 0) // self.height, (view.bottom - 1) // self.height + 1):
+            for cx in range(max(view.left, 0) // self.width, (view.right - 1) // self.width + 1):
+                chunk = self.get(cx, cy)
+                if chunk:
+                    blits.append((chunk, (cx * self.width + dx, cy * self.height + dy)))
+        return blits
+
+
+class Background:
+    # фон из cols x rows картинок game_fon.png, соседние отражены.
+    # Отражений всего четыре, они готовятся один раз, а рисуются
+    # только картинки, попавшие на экран (от 1 до 4)
+    def __init__(self, assets, cols, rows):
+        image = assets.load('game_fon.png')
+        self.flips = {(i, j): pygame.transform.flip(image, i, j) for i in range(2) for j in range(2)}
+        self.w, self.h = image.get_size()
+        self.cols = cols
+        self.rows = rows
+
+    def visible(self, screen_rect, offset):
+        # левый верхний угол фона сдвинут на треть картинки и на offset
+        x0 = -self.w // 3 + offset[0]
+        y0 = -self.h // 3 + offset[1]
+        blits = []
+        for i in range(max((screen_rect.left - x0) // self.w, 0),
+                       min((screen_rect.right - 1 - x0) // self.w, self.cols - 1) + 1):
+            for j in range(max((screen_rect.top - y0) // self.h, 0),
+                           min((screen_rect.bottom - 1 - y0) // self.h, self.rows - 1) + 1):
+                blits.append((self.flips[(i % 2, j % 2)], (x0 + self.w * i, y0 + self.h * j)))
+        return blits
+
+
+class Renderer:
+    # отрисовка уровня: тайлы берутся из сетки карты только
+    # в пределах окна камеры, остальные спрайты отсекаются по экрану.
+    # Спрайты уровня хранят мировые координаты, сдвиг камеры
+    # добавляется только при выводе на экран
+    def __init__(self, game, sim):
+        self.game = game
+        self.sim = sim
+        self.screen_rect = game.screen.get_rect()
+        self.chunks = ChunkCache(sim)
+        # число картинок в последнем кадре
+        self.blits = 0
+        # фон на всю ширину и высоту карты
+        self.background = Background(game.assets, sim.level_map.width // 25 + 1,
+                                     sim.level_map.height // 10 + 1)
+
+    # alpha - доля времени, прошедшая с последнего шага физики
+    def draw(self, screen, alpha=1.0):
+        sim = self.sim
+        camera = self.game.camera
+        view = camera.view()
+
+        blits = self.background.visible(self.screen_rect, sim.fon_offset)
+        blits.extend(self.chunks.visible(view, camera.dx, camera.dy))
+        blits.extend((tile.image, camera.apply(tile)) for tile in sim.pickup_group.query(view))
+        blits.extend((enemy.image, camera.apply(enemy, alpha)) for enemy in sim.enemy_group
+                     if enemy.rect.colliderect(view))
+        blits.append((sim.player.image, camera.apply(sim.player, alpha)))
+        blits.extend((sprite.image, sprite.rect) for sprite in self.game.hud)
+        screen.blits(blits, doreturn=False)
+        self.blits = len(blits)
+
+
 class Camera:
     # начальный сдвиг камеры
     def __init__(self, game):
@@ -278,20 +1342,305 @@ class Camera:
         self.WIDTH = game.WIDTH
         self.HEIGHT = game.HEIGHT
 
-    # сдвинуть объект obj на смещение камеры
-    def apply(self, obj):
-        obj.rect.x += self.dx
-        if obj.name != "other":
-            obj.rect.y += self.dy
+    # положение объекта obj на экране,
+    # для подвижных объектов - между двумя шагами физики
+    def apply(self, obj, alpha=None):
+        if alpha is None:
+            return obj.rect.move(self.dx, self.dy)
+        x, y = interpolate(obj, alpha)
+        return x + self.dx, y + self.dy
+
+    # видимая часть уровня в мировых координатах
+    def view(self):
+        return pygame.Rect(-self.dx, -self.dy, self.WIDTH, self.HEIGHT)
 
     # позиционировать камеру на объекте target
-    def update(self, target):
-        self.dx = self.WIDTH // 2 - (target.rect.x + target.rect.w // 2)
-        self.dy = self.HEIGHT // 2 - (target.rect.y + target.rect.h // 2)
+    def update(self, target, alpha=1.0):
+        x, y = interpolate(target, alpha)
+        self.dx = self.WIDTH // 2 - (x + target.rect.w // 2)
+        self.dy = self.HEIGHT // 2 - (y + target.rect.h // 2)
+
+
+class Simulation:
+    # уровень и его физика без окна, звука и отрисовки: уровень можно
+    # прогонять шагами быстрее реального времени (проверка уровней, замеры).
+    # Окно не нужно, на серверах достаточно SDL_VIDEODRIVER=dummy
+    tile_width = tile_height = 70
+    # карты шире stream_width столбцов подгружаются кусками по stream_chunk
+    # столбцов: спрайты есть только у кусков рядом с героем
+    stream_width = 200
+    stream_chunk = 16
+    stream_ahead = 2
+    stream_behind = 2
+    # с какого числа врагов они обновляются массивами numpy (EnemyGroup):
+    # по замерам до ~20 врагов по одному быстрее
+    numpy_enemies = 20
+
+    # level - номер уровня или уже загруженная карта,
+    # data - данные игры (облик героя, монеты), assets - кэш картинок,
+    # stream - подгружать карту кусками (None - только широкие карты),
+    # seed - зерно случайных наград за монеты (None - любое)
+    def __init__(self, level, data=None, assets=None, stream=None, seed=None):
+        self.data = data if data is not None else new_progress()
+        # свой генератор: с тем же зерном и нажатиями уровень проходит так же
+        self.seed = seed if seed is not None else randrange(1 << 32)
+        self.random = Random(self.seed)
+        self.assets = assets if assets is not None else Assets()
+        self.images = {name: self.assets.load(file) for name, file in IMAGES.items()}
+
+        # группы спрайтов по назначению: за шаг обновляются только враги
+        # (монеты анимируются все сразу, герой обновляется последним),
+        # их группа создается по карте уровня.
+        # Неподвижные тайлы и монеты индексируем сеткой по клеткам карты:
+        # по ней ищутся столкновения и видимые на экране флаг и монеты.
+        # pickup_group - флаг и монеты, block_group - твердые тайлы,
+        # danger_group - шипы
+        self.pickup_group = TileGrid(self)
+        self.block_group = TileGrid(self)
+        self.danger_group = TileGrid(self)
+        # сдвиг фона на экране, его двигает герой
+        self.fon_offset = [0, 0]
+
+        # загруженные куски карты: номер - спрайты куска,
+        # живые враги по клеткам появления и собранные монеты
+        self.chunks = {}
+        self.enemies = {}
+        self.taken = set()
+
+        # загружаем уровень
+        self.level_map = load_level(level) if type(level) is int else level
+        if stream is None:
+            stream = self.level_map.width > self.stream_width
+        self.stream = stream
+        # массивы numpy окупаются только при многих врагах сразу
+        if numpy and self.enemy_count() >= self.numpy_enemies:
+            self.enemy_group = EnemyGroup(self)
+        else:
+            self.enemy_group = pygame.sprite.Group()
+
+        x, y = self.level_map.spawn
+        self.player = Player(self, x * self.tile_width, y * self.tile_height)
+        if self.stream:
+            self.stream_level()
+        else:
+            self.generate_level(0, self.level_map.width)
+
+        self.lifes = 3
+        self.got_coins = 0
+        self.victory = False
+        self.ticks = 0
+        Coin.cur_frame = 0
+
+    def finished(self):
+        return self.victory or not self.lifes
+
+    def enemy_count(self):
+        # сколько врагов обновляется сразу: на всей карте или, если карта
+        # подгружается кусками, в кусках вокруг героя в начале уровня
+        columns = range(self.level_map.width)
+        if self.stream:
+            x = self.level_map.spawn[0] // self.stream_chunk * self.stream_chunk
+            columns = range(max(x - self.stream_behind * self.stream_chunk, 0),
+                            min(x + (self.stream_ahead + 1) * self.stream_chunk, self.level_map.width))
+        return sum(self.level_map.column(x).count('*') for x in columns)
+
+    def step(self, keys=0, ticks=1):
+        # ticks шагов физики с нажатыми кнопками keys (биты KEY_*)
+        for i in range(ticks):
+            if self.finished():
+                break
+            if self.stream:
+                self.stream_level()
+
+            # проверка нажатых кнопок
+            for key, move in KEY_MOVES:
+                if keys & key:
+                    self.player.move(*move)
+
+            # обновляем спрайты
+            if Coin.frames:
+                Coin.animate()
+            self.enemy_group.update()
+            self.player.update()
+            self.ticks += 1
+
+    def state(self):
+        return {
+            "ticks": self.ticks,
+            "x": self.player.rect.x,
+            "y": self.player.rect.y,
+            "lifes": self.lifes,
+            "coins": self.got_coins,
+            "victory": self.victory,
+            "finished": self.finished()
+        }
+
+    def stream_level(self):
+        # подгружаем куски рядом с героем и выгружаем далекие,
+        # с запасом в кусок, чтобы на границе куски не загружались каждый шаг
+        size = self.stream_chunk * self.tile_width
+        cur = self.player.rect.centerx // size
+        last = (self.level_map.width - 1) // self.stream_chunk
+        for chunk in range(max(cur - self.stream_behind, 0), min(cur + self.stream_ahead, last) + 1):
+            if chunk not in self.chunks:
+                self.chunks[chunk] = self.generate_level(chunk * self.stream_chunk,
+                                                         min((chunk + 1) * self.stream_chunk,
+                                                             self.level_map.width))
+        first, last = cur - self.stream_behind - 1, cur + self.stream_ahead + 1
+        for chunk in list(self.chunks):
+            if not first <= chunk <= last:
+                self.release_chunk(chunk)
+        # враги уходят со своего места: выгружаем всех, кто сейчас
+        # вне оставленных кусков, даже если их кусок еще загружен
+        for cell, enemy in list(self.enemies.items()):
+            if not first <= enemy.rect.centerx // size <= last:
+                enemy.kill()
+                del self.enemies[cell]
+
+    def release_chunk(self, chunk):
+        for sprite in self.chunks.pop(chunk):
+            sprite.kill()
+
+    def generate_level(self, x0, x1):
+        # создаем спрайты столбцов x0..x1 карты и возвращаем их
+        sprites = []
+        columns = [self.level_map.column(x) for x in range(x0, x1)]
+        for y in range(self.level_map.height):
+            for x, column in enumerate(columns, x0):
+                if column[y] == '#':
+                    sprites.append(Tile(self, 'ground', x, y, self.block_group, name="ground"))
+
+                elif column[y] == '+':
+                    sprites.append(Tile(self, 'box', x, y, self.block_group, name="box"))
+
+                elif column[y] == '%':
+                    sprites.append(Tile(self, 'stones', x, y, self.block_group, name="stones"))
+
+                elif column[y] == '^':
+                    sprites.append(Tile(self, 'thorns', x, y, self.block_group, self.danger_group,
+                                        name="thorns"))
+
+                elif column[y] == '-':
+                    sprites.append(Tile(self, 'step', x, y, self.block_group, name='step'))
+
+                elif column[y] == '*':
+                    # враг еще бродит по соседнему куску - второго не создаем
+                    if (x, y) not in self.enemies:
+                        self.enemies[(x, y)] = Enemy(self, x, y)
+
+                elif column[y] == '&':
+                    sprites.append(Tile(self, 'flag', x, y, self.pickup_group, name="flag"))
+
+                elif column[y] == "$":
+                    if (x, y) not in self.taken:
+                        sprites.append(Coin(self, x, y))
+        return sprites
+
+
+# запись игры: магия, версия, облик героя, уровень, зерно, число шагов
+REPLAY_HEADER = struct.Struct('<4sBBHII')
+REPLAY_MAGIC = b'NNRP'
+REPLAY_VERSION = 1
+
+
+class Replay:
+    # нажатые кнопки на каждом шаге физики и все, от чего еще зависит
+    # уровень: номер, облик героя (от него маска) и зерно Simulation.
+    # Шаги хранятся сериями одинаковых нажатий [кнопки, число шагов],
+    # в файле серия - число (шаги << 3 | кнопки) по 7 бит в байте,
+    # так что серия до 15 шагов занимает байт, до 2047 - два байта
+    def __init__(self, level, seed, hero=0, runs=None):
+        self.level = level
+        self.seed = seed
+        self.hero = hero
+        self.runs = runs if runs is not None else []
+
+    @staticmethod
+    def start(sim, level):
+        # запись уровня, только что созданного в sim
+        colors = sim.data["hero_colors"]
+        hero = [colors[h] for h in colors].index("ok")
+        return Replay(level, sim.seed, hero)
+
+    def record(self, keys):
+        if self.runs and self.runs[-1][0] == keys:
+            self.runs[-1][1] += 1
+        else:
+            self.runs.append([keys, 1])
+
+    def ticks(self):
+        return sum(count for keys, count in self.runs)
+
+    def keys(self):
+        # нажатия по шагам
+        for keys, count in self.runs:
+            for i in range(count):
+                yield keys
+
+    def data(self):
+        # данные игры с тем же обликом героя
+        data = new_progress()
+        colors = data["hero_colors"]
+        for i, hero in enumerate(colors):
+            colors[hero] = "ok" if i == self.hero else 0
+        return data
+
+    def simulation(self, assets=None):
+        return Simulation(self.level, self.data(), assets, seed=self.seed)
+
+    def play(self, assets=None):
+        # прогон записи без окна с неограниченной скоростью
+        sim = self.simulation(assets)
+        for keys in self.keys():
+            if sim.finished():
+                break
+            sim.step(keys)
+        return sim
+
+    def to_bytes(self):
+        out = bytearray(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, self.hero, self.level,
+                                           self.seed, self.ticks()))
+        for keys, count in self.runs:
+            value = count << 3 | keys
+            while value > 0x7f:
+                out.append(value & 0x7f | 0x80)
+                value >>= 7
+            out.append(value)
+        return bytes(out)
+
+    @staticmethod
+    def from_bytes(data):
+        magic, version, hero, level, seed, ticks = REPLAY_HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError("not a NoNamio replay")
+        runs = []
+        value = shift = 0
+        for byte in data[REPLAY_HEADER.size:]:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                runs.append([value & 7, value >> 3])
+                value = shift = 0
+        replay = Replay(level, seed, hero, runs)
+        if replay.ticks() != ticks:
+            raise ValueError("replay is truncated")
+        return replay
+
+    def save(self, path):
+        with open(path, 'wb') as file:
+            file.write(self.to_bytes())
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as file:
+            return Replay.from_bytes(file.read())
 
 
 class Game:
-    def __init__(self, width, height):
+    # max_fps - ограничение частоты отрисовки уровня (0 - без ограничения),
+    # replay - показать эту запись игры вместо меню,
+    # level - сразу начать эту карту (например, сгенерированную)
+    def __init__(self, width, height, max_fps=60, replay=None, level=None):
         pygame.init()
         pygame.display.set_caption("NoNamio")
 
@@ -299,33 +1648,36 @@ class Game:
         self.screen = pygame.display.set_mode(self.SIZE)
 
         self.clock = pygame.time.Clock()
+        self.max_fps = max_fps
 
         pygame.mixer.pre_init(frequency=44100)
         self.sounds = {
             "transition": pygame.mixer.Sound('data/sounds & music/transition.wav'),
+            "win": pygame.mixer.Sound('data/sounds & music/win.wav'),
+            "lose": pygame.mixer.Sound('data/sounds & music/lose.wav')
         }
 
-        self.images = {
-            'box': load_image('box.png'),
-            'ground': load_image('ground.png'),
-            'stones': load_image('stones.png'),
-            'thorns': load_image('thorns.png'),
-            'step': load_image('step.png'),
-            'enemy': load_image('ghost.png'),
-            'flag': load_image('flag.png'),
-            'empty': load_image('empty.png'),
-            'pause': load_image('pause.png'),
-            'dark_fon': load_image('dark_fon.png'),
-            'coins': load_image('coins.png'),
-            'locked_level': load_image('locked_level.png'),
-            'locked_level_pay': load_image('locked_level_pay.png'),
-            'sound': load_image('sound.png'),
-            'music': load_image('music.png'),
-            'non_sound': load_image('non_sound.png'),
-            'non_music': load_image('non_music.png')
-        }
-
-        self.tile_width = self.tile_height = 70
+        # все картинки загружаются через кэш
+        self.assets = Assets()
+        self.texts = TextCache()
+        # готовые фоны меню по размеру окна
+        self.menu_fons = dict()
+        # фон меню, на котором рисуется кадр, и что на нем нарисовано,
+        # то же для кадра, уже выведенного на экран
+        self.backdrop = None
+        self.drawn = []
+        self.shown_backdrop = None
+        self.shown = []
+
+        # замеры кадров игры: показ по клавише "P",
+        # при заданной NONAMIO_PROFILE выгрузка в этот файл (csv или json),
+        # только тогда кадры и хранятся
+        self.profile_path = os.environ.get("NONAMIO_PROFILE")
+        self.profiler = Profiler(keep_frames=bool(self.profile_path))
+        self.show_profiler = False
+        # при заданной NONAMIO_REPLAYS каждая игра записывается в эту папку
+        self.replay_dir = os.environ.get("NONAMIO_REPLAYS")
+        self.images = {name: self.assets.load(file) for name, file in IMAGES.items()}
 
         # загрузка данных
         try:
@@ -335,11 +1687,15 @@ class Game:
             self.null_progress()
 
         # запуск игры
-        self.start_ui()
+        self.start_ui((self.watch_replay, replay) if replay else
+                      (self.start_game, level) if level else (self.menu,))
 
-    def start_ui(self):
-        while self.menu():
-            pass
+    def start_ui(self, scene):
+        # экраны не вызывают друг друга, а возвращают следующий экран -
+        # метод и его аргументы. Поэтому стек не растет, сколько бы раз
+        # ни перезапускался уровень, а старые уровни сразу освобождаются
+        while True:
+            scene = scene[0](*scene[1:])
 
     def menu(self):
         self.play_fon_music(False)
@@ -347,23 +1703,23 @@ class Game:
         self.render_text("NoNamio".ljust(14), self.WIDTH // 2, 80,
                          size=120, color=NEON, italic=True, u=True)
 
-        self.screen.blit(self.images["coins"], (20, 140))
+        self.blit(self.images["coins"], (20, 140))
         self.render_text(str(self.data["coins"]), 70, 150,
                          size=40, color=WHITE, italic=True)
 
-        # словарь координат элементов и их функций
-        all_elements = dict()
+        # кнопки экрана и их функции
+        all_elements = Widgets()
         all_elements.update(self.render_bar())
 
         # кнопка вкл/окл звука
         img = self.images['sound' if self.data["sound"] else 'non_sound']
-        self.screen.blit(img, (30, 200))
-        all_elements[(30, 200, 30 + img.get_width(), 200 + img.get_height())] = self.invert_sound
+        self.blit(img, (30, 200))
+        all_elements.add((30, 200, 30 + img.get_width(), 200 + img.get_height()), self.invert_sound)
 
         # кнопка вкл/откл музыки
         img = self.images['music' if self.data["music"] else 'non_music']
-        self.screen.blit(img, (30, 260))
-        all_elements[(30, 260, 30 + img.get_width(), 260 + img.get_height())] = self.invert_music
+        self.blit(img, (30, 260))
+        all_elements.add((30, 260, 30 + img.get_width(), 260 + img.get_height()), self.invert_music)
 
         # Строка уровней
         offset = 30  # для параллелепипеда
@@ -388,11 +1744,11 @@ class Game:
                 y1 = start_y + frame_width // 10
                 # если уровень платный, выводим замок другого цвета
                 img = self.images["locked_level" if self.data["levels"][n] == -1 else "locked_level_pay"]
-                self.screen.blit(img, (x1, y1))
+                self.blit(img, (x1, y1))
 
             rect = pygame.Rect(start_x + i * (frame_width + space + offset), 250, 50, 50)
-            # добовляем координаты крайних точек в словарь
-            all_elements[(rect.x, rect.y, rect.x + rect.w, rect.y + rect.h)] = (self.start_game, i + 1)
+            # добовляем кнопку уровня
+            all_elements.add(rect, (self.start_game, i + 1))
             # обрамляем
             self.frame_obj(rect, offset=offset)
 
@@ -400,239 +1756,284 @@ class Game:
         # задаем шаблон (rect) для всех рамок, нарисовав первую
         rect = self.render_text("New Game", None, 350, size=80, color=BLUE, center=True)
         self.frame_obj(rect)  # обрамляем
-        # добовляем в словарь
-        all_elements[(rect.x, rect.y, rect.x + rect.w, rect.y + rect.h)] = self.new_game
+        # добовляем кнопку
+        all_elements.add(rect, (self.new_game,))
 
-        for new_y, name, func in ((435, "Store", self.store),
+        for new_y, name, func in ((435, "Store", (self.store,)),
                                   (520, "Quit", self.close),
-                                  (605, "Help", self.help_info)):
+                                  (605, "Help", (self.help_info,))):
             rect.y = new_y  # снижаем рамку
             self.render_text(name, None, new_y, size=80, color=BLUE, center=True)
             self.frame_obj(rect)
-            all_elements[(rect.x, rect.y, rect.x + rect.w, rect.y + rect.h)] = func
+            all_elements.add(rect, func)
 
-        pygame.display.flip()  # обновляем дисплей
+        self.show()  # обновляем дисплей
 
         # обрабатываем события
-        # т.к. меню статичное, ставим наименьший fps, чтобы не нагружать процессор
-        fps = 5
-        # при любом обновлении информации на экране,
-        # меню перерисовываем заново, возвращая True для start_ui
+        # при любом обновлении информации на экране
+        # меню перерисовываем заново, возвращая его же
         while True:
-            for event in pygame.event.get():
-                # коректный выход
-                if event.type == pygame.QUIT:
-                    # спрашиваем пользователя, уверен ли он
-                    if not self.close():
-                        self.start_ui()
-                # проверка горячих клавиши
-                elif self.check_hot_keys(event):
-                    return True
-                # при клике
-                elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (1, 3):
-                    x, y = event.pos
-                    # нахдим, попала ли мышь в область функционирующих элементов
-                    element = list(filter(lambda e: e[0] <= x <= e[2] and e[1] <= y <= e[3],
-                                          all_elements.keys()))
-                    if element:
-                        self.play_sound()  # звуковой переход
-                        element = all_elements[element[0]]
-                        # вызываем функцию кнопки
-                        if type(element) == tuple:
-                            # если есть аргумент, передаем его
-                            element[0](element[1])
-                            return True
-                        elif callable(element):
-                            element()
-                            return True
-            self.clock.tick(fps)
-
+            element = self.wait_click(all_elements)
+            # коректный выход
+            if element == "QUIT":
+                # спрашиваем пользователя, уверен ли он
+                self.close()
+                return self.menu,
+            # проверка горячих клавиши
+            elif element == "HOT_KEY":
+                return self.menu,
+            # переходим на экран кнопки
+            elif type(element) == tuple:
+                return element
+            # или вызываем ее функцию
+            elif callable(element):
+                element()
+                return self.menu,
+
+    # level - номер уровня или готовая карта (LevelMap, LevelStream)
     def start_game(self, level):
+        numbered = type(level) is int
         # проверка на доступность уровня
-        if self.data["levels"][str(level)] not in (0, "ok"):
-            return False
-        for i in range(1, level):
+        if numbered and self.data["levels"][str(level)] not in (0, "ok"):
+            return self.menu,
+        for i in range(1, level if numbered else 1):
             if self.data["levels"][str(i)] != "ok":
-                return False
+                return self.menu,
 
         self.play_fon_music(True)
 
-        # группы спрайтов
-        self.all_sprites = pygame.sprite.Group()
-        self.tiles_group = pygame.sprite.Group()
-        self.block_group = pygame.sprite.Group()
-        self.danger_group = pygame.sprite.Group()
-
-        # загружаем уровень
-        self.level_map = load_level(level)
-
-        # создаем фон на всю ширину и высоту карты
-        self.game_fon = []
-        w = 1800
-        h = 1081
-        for i in range(len(self.level_map[0]) // 25 + 1):
-            for j in range(len(self.level_map) // 10 + 1):
-                img = pygame.transform.flip(load_image('game_fon.png'),
-                                            (i % 2), (j % 2))
-                self.game_fon.append(MySprite(self, img, (-w // 3 + w * i),
-                                              (-h // 3 + h * j), abs_coords=True))
-
-        self.generate_level()
-        self.camera = Camera(self)
+        # уровень и его физика
+        sim = self.sim = Simulation(level, self.data, self.assets)
+        # нажатия по шагам физики для повтора игры;
+        # у карты без номера (уровень 0) запись не сохраняется
+        replay = Replay.start(sim, level if numbered else 0)
 
         # независимые спрайты кнопки паузы и монет
-        MySprite(self, self.images["pause"], 10, 10, abs_coords=True)
-        MySprite(self, self.images["coins"], self.WIDTH - 270, 17, abs_coords=True)
-
-        self.lifes = 3
-        self.got_coins = 0
-        self.victory = False
+        self.hud = [MySprite(sim, self.images["pause"], 10, 10, abs_coords=True),
+                    MySprite(sim, self.images["coins"], self.WIDTH - 270, 17, abs_coords=True)]
 
         keys = {
-            (0, -1): False,  # UP
-            (1, 0): False,  # RIGHT
-            (-1, 0): False   # LEFT
+            KEY_UP: False,
+            KEY_RIGHT: False,
+            KEY_LEFT: False
         }
 
-        fps = 50
-        running = True
-        while running:
+        def handle(event):
+            if event.type == pygame.QUIT:
+                self.close(replay)
+                return "PAUSED"
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (1, 3):
+                x, y = event.pos
+                # если клик по области кнопки паузы
+                if 10 <= x <= 60 and 10 <= y <= 60:
+                    self.play_sound()
+                    answ = self.pause()
+                    if answ == "RESTART":
+                        self.save_profile()
+                        self.save_replay(replay)
+                        return self.start_game, level
+                    elif answ == "Menu":
+                        self.save_profile()
+                        self.save_replay(replay)
+                        return self.menu,
+                    return "PAUSED"
+            # обработка нажатия клавиш
+            elif event.type == pygame.KEYDOWN:
+                if event.key in (32, 119, 172, 273):  # UP
+                    keys[KEY_UP] = True
+                elif event.key in (100, 162, 275):  # RIGHT
+                    keys[KEY_RIGHT] = True
+                elif event.key in (97, 160, 276):  # LEFT
+                    keys[KEY_LEFT] = True
+                else:
+                    self.check_hot_keys(event)
+            # обработка отпускания клавиш
+            elif event.type == pygame.KEYUP:
+                if event.key in (32, 119, 172, 273):  # UP
+                    keys[KEY_UP] = False
+                elif event.key in (100, 162, 275):  # RIGHT
+                    keys[KEY_RIGHT] = False
+                elif event.key in (97, 160, 276):  # LEFT
+                    keys[KEY_LEFT] = False
+
+        def next_keys():
+            pressed = sum(key for key in keys if keys[key])
+            replay.record(pressed)
+            return pressed
+
+        scene = self.play_level(sim, handle, next_keys, lambda: self.data["coins"])
+        if scene is not None:
+            return scene
+        self.save_profile()
+        self.save_replay(replay)
+
+        # проверка на выигрыш
+        if sim.victory:
+            answ = self.win(level)
+            if answ in ("RESTART", "NEXT"):
+                return self.start_game, level + (1 if answ == "NEXT" else 0)
+            return self.menu,
+
+        # проигрыш
+        answ = self.lose()
+        if answ == "RESTART":
+            return self.start_game, level
+        return self.menu,
+
+    def watch_replay(self, replay):
+        # показ записанной игры в реальном времени,
+        # клик или любая клавиша - выход в меню
+        sim = self.sim = replay.simulation(self.assets)
+        self.hud = []
+        pygame.display.set_caption("NoNamio - replay of level {}".format(replay.level))
+
+        def handle(event):
+            if event.type == pygame.QUIT:
+                self.terminate()
+            elif event.type in (pygame.MOUSEBUTTONDOWN, pygame.KEYDOWN):
+                return self.menu,
+
+        # запись может кончиться раньше уровня (выход через паузу)
+        keys = replay.keys()
+        self.play_level(sim, handle, lambda: next(keys, None), lambda: sim.got_coins)
+        pygame.display.set_caption("NoNamio")
+        return self.menu,
+
+    def play_level(self, sim, handle, next_keys, coins):
+        # общий цикл кадров уровня для игры и для показа записи.
+        # handle(event) разбирает событие и возвращает сцену для выхода,
+        # "PAUSED" после диалога (время в нем не учитывается) или None;
+        # next_keys() - нажатия на следующий шаг физики, None - нажатий больше нет;
+        # coins() - число монет на экране.
+        # Возвращает сцену из handle, иначе None: уровень окончен
+        # (его последний кадр на экране) или кончились нажатия
+        self.camera = Camera(self)
+        self.renderer = Renderer(self, sim)
+
+        # физика идет шагами фиксированной длины независимо от частоты кадров:
+        # за кадр выполняется столько шагов, сколько накопилось времени
+        tick = 1000 / TICK_RATE
+        accumulator = 0
+        last_time = pygame.time.get_ticks()
+        profiler = self.profiler
+        while True:
+            profiler.begin()
             for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.close()
-                elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (1, 3):
-                    x, y = event.pos
-                    # если клик по области кнопки паузы
-                    if 10 <= x <= 60 and 10 <= y <= 60:
-                        self.play_sound()
-                        answ = self.pause()
-                        if answ == "RESTART":
-                            self.all_sprites.clear(self.screen, self.images['dark_fon'])
-                            self.start_game(level)
-                            return False
-                        elif answ == "Menu":
-                            return False
-                # обработка нажатия клавиш
-                elif event.type == pygame.KEYDOWN:
-                    if event.key in (32, 119, 172, 273):  # UP
-                        keys[(0, -1)] = True
-                    elif event.key in (100, 162, 275):  # RIGHT
-                        keys[(1, 0)] = True
-                    elif event.key in (97, 160, 276):  # LEFT
-                        keys[(-1, 0)] = True
-                    else:
-                        self.check_hot_keys(event)
-                # обработка отпускания клавиш
-                elif event.type == pygame.KEYUP:
-                    if event.key in (32, 119, 172, 273):  # UP
-                        keys[(0, -1)] = False
-                    elif event.key in (100, 162, 275):  # RIGHT
-                        keys[(1, 0)] = False
-                    elif event.key in (97, 160, 276):  # LEFT
-                        keys[(-1, 0)] = False
-
-            # проверка нажатых кнопок
-            for k in keys:
-                if keys[k]:
-                    self.player.move(*k)
-
-            # обновляем спрайты
-            self.all_sprites.update()
-            # изменяем ракурс камеры
-            self.camera.update(self.player)
-            # обновляем положение всех спрайтов
-            for sprite in self.all_sprites:
-                if sprite.name != "other":
-                    self.camera.apply(sprite)
-
-            # перерисовываем экран со спрайтами
+                scene = handle(event)
+                if scene == "PAUSED":
+                    last_time = pygame.time.get_ticks()
+                    profiler.begin()
+                elif scene is not None:
+                    return scene
+            profiler.mark("events")
+
+            now = pygame.time.get_ticks()
+            accumulator = min(accumulator + now - last_time, tick * MAX_TICKS_PER_FRAME)
+            last_time = now
+
+            while accumulator >= tick and not sim.finished():
+                accumulator -= tick
+                pressed = next_keys()
+                if pressed is None:
+                    return None
+                sim.step(pressed)
+            profiler.mark("update")
+
+            # изменяем ракурс камеры, спрайты остаются на своих местах,
+            # подвижные рисуются между двумя последними шагами
+            alpha = accumulator / tick
+            self.camera.update(sim.player, alpha)
+            profiler.mark("camera")
+
+            # перерисовываем видимую часть уровня
             self.screen.fill((0, 0, 0))
-            self.all_sprites.draw(self.screen)
+            self.renderer.draw(self.screen, alpha)
+            profiler.mark("draw")
 
             # отображаем жизни
-            for i in range(self.lifes):
+            for i in range(sim.lifes):
                 pygame.draw.circle(self.screen, RED, (self.WIDTH - 40 - i * 30, 40), 10)
             # деньги
-            self.render_text(str(self.data["coins"]), self.WIDTH - 220, 27,
+            self.render_text(str(coins()), self.WIDTH - 220, 27,
                              size=40, color=BLACK, italic=True)
-
-            # проверка на выигрыш
-            if self.victory:
-                answ = self.win(level)
-                if answ in ("RESTART", "NEXT"):
-                    self.all_sprites.clear(self.screen, self.images['dark_fon'])
-                    self.start_game(level + (1 if answ == "NEXT" else 0))
-                return True
-
-            # проверка на проигрыш
-            if self.lifes == 0:
-                answ = self.lose()
-                if answ == "RESTART":
-                    self.all_sprites.clear(self.screen, self.images['dark_fon'])
-                    self.start_game(level)
-                return False
-
-            pygame.display.flip()
-            self.clock.tick(fps)
+            profiler.mark("hud")
+            if self.show_profiler:
+                lines = profiler.report()
+                pygame.draw.rect(self.screen, BLACK, (5, 75, 250, len(lines) * 18 + 8))
+                for i, line in enumerate(lines):
+                    self.render_text(line, 10, 80 + i * 18, size=20, color=WHITE)
+                # сам замер рисуется отдельным этапом, не в счет "flip"
+                profiler.mark("profiler")
+
+            # итог уровня рисуется поверх последнего кадра
+            if sim.finished():
+                return None
+
+            self.show(full=True)
+            profiler.mark("flip")
+            self.clock.tick(self.max_fps)
+            profiler.mark("wait")
+
+            # счетчики кадра
+            profiler.count("queries", sim.pickup_group.queries + sim.block_group.queries +
+                           sim.danger_group.queries)
+            sim.pickup_group.queries = sim.block_group.queries = sim.danger_group.queries = 0
+            profiler.count("blits", self.renderer.blits)
+            profiler.end()
 
     def pause(self):
         self.render_dark()
 
-        self.screen.blit(load_image('restart.png'), (220, 230))
+        self.screen.blit(self.images['restart'], (220, 230))
         pygame.draw.polygon(self.screen, NEON, [(600, 230), (750, 330), (600, 430)])
 
-        all_elements = {(220, 230, 420, 430): "RESTART",
-                        (600, 230, 750, 4300): "CONTINUE"}
+        all_elements = Widgets()
+        all_elements.add((220, 230, 420, 430), "RESTART")
+        all_elements.add((600, 230, 750, 4300), "CONTINUE")
 
         all_elements.update(self.render_bar("pause"))
 
-        pygame.display.flip()
+        self.show(full=True)
 
-        fps = 5
         while True:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.close()
-                    return False
-                elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (1, 3):
-                    x, y = event.pos
-                    element = list(filter(lambda e: e[0] <= x <= e[2] and e[1] <= y <= e[3],
-                                          all_elements.keys()))
-                    if element:
-                        self.play_sound()
-                        element = all_elements[element[0]]
-                        if element in ("RESTART", "CONTINUE", "Menu"):
-                            return element
-                else:
-                    self.check_hot_keys(event)
-            self.clock.tick(fps)
+            element = self.wait_click(all_elements)
+            if element == "QUIT":
+                self.close()
+                return False
+            elif element in ("RESTART", "CONTINUE", "Menu"):
+                return element
 
     def win(self, level):
         self.play_fon_music(False)
-        self.play_sound(pygame.mixer.Sound('data/sounds & music/win.wav'))
+        self.play_sound(self.sounds["win"])
         self.render_dark()
 
-        if self.data["levels"][str(level)] != "ok":
+        if type(level) is not int:
+            # карта без номера: только монеты, собранные на ней
+            coins = 0
+        elif self.data["levels"][str(level)] != "ok":
             # размер вознаграждения, если уровень пройден впервые
             self.data["levels"][str(level)] = "ok"
-            coins = choice(range(level * 10, level * 15 + 1, 5))
+            coins = self.sim.random.choice(range(level * 10, level * 15 + 1, 5))
         else:
-            coins = choice(range(level * 2, level * 5 + 1, 2))
+            coins = self.sim.random.choice(range(level * 2, level * 5 + 1, 2))
 
         # учитываем в вознаграждении оставшиеся жизни
-        coins = int(coins * self.lifes * 2 / 3)
+        coins = int(coins * self.sim.lifes * 2 / 3)
         # выводим на экран
-        self.render_text("YOU GOT {} + {} COINS!".format(self.got_coins, coins), self.WIDTH - 500, 50,
+        self.render_text("YOU GOT {} + {} COINS!".format(self.sim.got_coins, coins), self.WIDTH - 500, 50,
                          size=50, color=BLUE)
         # сохраняем
-        self.data["coins"] += coins + self.got_coins
-        self.got_coins = 0
+        self.data["coins"] += coins + self.sim.got_coins
+        self.sim.got_coins = 0
 
-        all_elements = dict()
+        all_elements = Widgets()
         all_elements.update(self.render_bar("WIN"))
 
         next_level = -1
-        if level < len(self.data["levels"]):
+        if type(level) is not int:
+            next_level = 0
+        elif level < len(self.data["levels"]):
             # если следующий уровень бесплатный, разблокируем
             if self.data["levels"][str(level + 1)] == -1:
                 self.data["levels"][str(level + 1)] = 0
@@ -641,129 +2042,97 @@ class Game:
                 next_level = 1
             else:
                 next_level = 0
-        elif self.lifes != 3:
+        elif self.sim.lifes != 3:
             next_level = 0
 
         if next_level == 1:
-            self.screen.blit(load_image('restart.png'), (220, 230))
-            self.screen.blit(load_image('next.png'), (600, 230))
-            all_elements.update({(220, 230, 420, 430): "RESTART",
-                                 (600, 230, 750, 430): "NEXT"})
+            self.screen.blit(self.images['restart'], (220, 230))
+            self.screen.blit(self.images['next'], (600, 230))
+            all_elements.add((220, 230, 420, 430), "RESTART")
+            all_elements.add((600, 230, 750, 430), "NEXT")
         elif next_level == 0:
             # доступных уровней нет,
             # или последний уровень пройден не идеально
-            self.screen.blit(load_image('restart.png'), (400, 230))
-            all_elements.update({(400, 230, 650, 430): "RESTART"})
+            self.screen.blit(self.images['restart'], (400, 230))
+            all_elements.add((400, 230, 650, 430), "RESTART")
         else:
             # игра закончена
             self.render_text("YOU WON!!!", None, 200, size=120, color=NEON, center=True)
             self.render_text("ALL LEVELS UNLOCKED!", None, 350, size=60, color=NEON, center=True)
 
-        pygame.display.flip()
+        self.show(full=True)
 
-        fps = 5
         while True:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.close()
-                    return False
-                elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (1, 3):
-                    x, y = event.pos
-                    element = list(filter(lambda e: e[0] <= x <= e[2] and e[1] <= y <= e[3],
-                                          all_elements.keys()))
-                    if element:
-                        self.play_sound()
-                        element = all_elements[element[0]]
-                        if element in ("RESTART", "NEXT", "Menu"):
-                            return element
-                else:
-                    self.check_hot_keys(event)
-            self.clock.tick(fps)
+            element = self.wait_click(all_elements)
+            if element == "QUIT":
+                self.close()
+                return False
+            elif element in ("RESTART", "NEXT", "Menu"):
+                return element
 
     def lose(self):
         self.play_fon_music(False)
-        self.play_sound(pygame.mixer.Sound('data/sounds & music/lose.wav'))
+        self.play_sound(self.sounds["lose"])
 
-        self.data['coins'] -= self.got_coins
-        self.got_coins = 0
+        self.data['coins'] -= self.sim.got_coins
+        self.sim.got_coins = 0
 
         self.render_dark()
-        self.screen.blit(load_image('restart.png'), (400, 230))
+        self.screen.blit(self.images['restart'], (400, 230))
 
-        all_elements = {(400, 230, 650, 430): "RESTART"}
+        all_elements = Widgets()
+        all_elements.add((400, 230, 650, 430), "RESTART")
         all_elements.update(self.render_bar("LOSE"))
 
-        pygame.display.flip()
+        self.show(full=True)
 
-        fps = 5
         while True:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.close()
-                    return False
-                elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (1, 3):
-                    x, y = event.pos
-                    element = list(filter(lambda e: e[0] <= x <= e[2] and e[1] <= y <= e[3],
-                                          all_elements.keys()))
-                    if element:
-                        self.play_sound()
-                        element = all_elements[element[0]]
-                        if element in ("RESTART", "Menu"):
-                            return element
-                else:
-                    self.check_hot_keys(event)
-            self.clock.tick(fps)
+            element = self.wait_click(all_elements)
+            if element == "QUIT":
+                self.close()
+                return False
+            elif element in ("RESTART", "Menu"):
+                return element
 
     def new_game(self):
-        self.render_menu_fon()
-        self.render_dark()
-        all_elements = dict()
+        self.render_menu_fon(dark=True)
+        all_elements = Widgets()
 
         rect = self.render_text("YES", 200, 350, size=80, color=BLUE)
         self.frame_obj(rect)
-        all_elements[(rect.x, rect.y, rect.x + rect.w, rect.y + rect.h)] = self.null_progress
+        all_elements.add(rect, self.null_progress)
 
         rect.x = self.WIDTH - rect.x - rect.w
         self.render_text("NO", 700, 350, size=80, color=BLUE)
         self.frame_obj(rect)
-        all_elements[(rect.x, rect.y, rect.x + rect.w, rect.y + rect.h)] = None
+        all_elements.add(rect, None)
 
         self.render_text("Are you sure?", None, 130, size=80,
                          color=BLUE, italic=True, center=True)
         self.render_text("All the progress will be lost!", None, 200,
                          size=80, color=BLUE, italic=True, center=True)
 
-        pygame.display.flip()
+        self.show()
 
-        fps = 5
         while True:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.close()
-                    return False
-                elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (1, 3):
-                    x, y = event.pos
-                    element = list(filter(lambda e: e[0] <= x <= e[2] and e[1] <= y <= e[3],
-                                          all_elements.keys()))
-                    if element:
-                        element = all_elements[element[0]]
-                        if element:
-                            element()
-                        return False
-                else:
-                    self.check_hot_keys(event)
-            self.clock.tick(fps)
+            element = self.wait_click(all_elements, sound=False)
+            if element == "QUIT":
+                self.close()
+                return self.menu,
+            elif element != "HOT_KEY":
+                if element:
+                    element()
+                return self.menu,
 
     def store(self):
-        self.render_menu_fon()
-        self.render_dark()
+        self.render_menu_fon(dark=True)
 
-        self.screen.blit(self.images["coins"], (self.WIDTH - 200, 45))
+        self.blit(self.images["coins"], (self.WIDTH - 200, 45))
 
         self.render_text(str(self.data["coins"]), self.WIDTH - 150, 53,
                          size=40, color=WHITE, italic=True)
 
-        all_elements = dict()
+        all_elements = Widgets()
         all_elements.update(self.render_bar("store"))
 
         # цвета героя
@@ -779,11 +2148,11 @@ class Game:
             # изображение
             pic = pygame.Surface((44, 70))
             pic.fill((255, 255, 255, 150))
-            pic.blit(load_image("heroes/{}L.png".format(colors[i])).subsurface(
+            pic.blit(self.assets.load("heroes/{}L.png".format(colors[i])).subsurface(
                 pygame.Rect(0, 0, 44, 70)), (0, 0)
             )
             rect_pic = pygame.Rect(rect.x + (rect.w - 44) // 2, 200, 44, 70)
-            self.screen.blit(pic, (rect_pic.x, rect_pic.y))
+            self.blit(pic, (rect_pic.x, rect_pic.y))
 
             # стоимость
             cost = self.data['hero_colors'][c]
@@ -801,8 +2170,8 @@ class Game:
                 else:
                     rect = rect_pic
 
-            # добавление в словарь элемента
-            all_elements[(rect.x, rect.y, rect.x + rect.w, rect.y + rect.h)] = func
+            # добавление кнопки
+            all_elements.add(rect, func)
 
         # доп. уровни
         levels = list(filter(lambda lev: type(self.data['levels'][lev]) is int and self.data['levels'][lev],
@@ -823,40 +2192,26 @@ class Game:
                                         size=45, color=WHITE, center=(rect.x, rect.w))
                 func = (self.buy_thing, 'levels', level)
                 self.frame_obj(rect)
-                all_elements[(rect.x, rect.y, rect.x + rect.w, rect.y + rect.h)] = func
+                all_elements.add(rect, func)
 
-        pygame.display.flip()
+        self.show()
 
-        fps = 5
         while True:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    if not self.close():
-                        self.start_ui()
-                elif self.check_hot_keys(event):
-                    return True
-                # при клике
-                elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (1, 3):
-                    x, y = event.pos
-                    element = list(filter(lambda e: e[0] <= x <= e[2] and e[1] <= y <= e[3],
-                                          all_elements.keys()))
-                    if element:
-                        self.play_sound()
-                        element = all_elements[element[0]]
-                        if type(element) == str:
-                            if element == "Menu":
-                                return True
-                        elif type(element) == tuple:
-                            if element[0](*element[1:]):
-                                self.store()
-                                return True
-            self.clock.tick(fps)
+            element = self.wait_click(all_elements)
+            if element == "QUIT":
+                self.close()
+                return self.menu,
+            elif element in ("HOT_KEY", "Menu"):
+                return self.menu,
+            # при клике по товару
+            elif type(element) == tuple:
+                if element[0](*element[1:]):
+                    return self.store,
 
     def help_info(self):
-        self.render_menu_fon()
-        self.render_dark()
+        self.render_menu_fon(dark=True)
 
-        all_elements = dict()
+        all_elements = Widgets()
         all_elements.update(self.render_bar("help"))
 
         with open('data/help_info.txt', encoding="utf-8") as data:
@@ -866,74 +2221,39 @@ class Game:
             # построчно отображаем текст из информационного файла
             self.render_text(help_text[i], 50, 140 + i * 40, color=(200, 200, 200))
 
-        pygame.display.flip()
+        self.show()
 
-        fps = 5
         while True:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    if not self.close():
-                        self.start_ui()
-                elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (1, 3):
-                    x, y = event.pos
-                    element = list(filter(lambda e: e[0] <= x <= e[2] and e[1] <= y <= e[3],
-                                          all_elements.keys()))
-                    if element:
-                        self.play_sound()
-                        if all_elements[element[0]] == "Menu":
-                            return True
-                else:
-                    self.check_hot_keys(event)
-            self.clock.tick(fps)
-
-    def generate_level(self):
-        for y in range(len(self.level_map)):
-            for x in range(len(self.level_map[0])):
-                if self.level_map[y][x] == '#':
-                    Tile(self, 'ground', x, y, self.block_group, self.tiles_group, name="ground")
-
-                elif self.level_map[y][x] == '+':
-                    Tile(self, 'box', x, y, self.block_group, self.tiles_group, name="box")
-
-                elif self.level_map[y][x] == '%':
-                    Tile(self, 'stones', x, y, self.block_group, self.tiles_group, name="stones")
-
-                elif self.level_map[y][x] == '^':
-                    Tile(self, 'thorns', x, y, self.block_group, self.danger_group, name="thorns")
-
-                elif self.level_map[y][x] == '-':
-                    Tile(self, 'step', x, y, self.block_group, name='step')
-
-                elif self.level_map[y][x] == '*':
-                    Enemy(self, x, y)
-
-                elif self.level_map[y][x] == '&':
-                    Tile(self, 'flag', x, y, name="flag")
-
-                elif self.level_map[y][x] == "$":
-                    Coin(self, x, y)
-
-                elif self.level_map[y][x] == '@':
-                    player = (x, y)
-
-        self.player = Player(self, player[0] * self.tile_width, player[1] * self.tile_height)
-
-    def render_menu_fon(self):
-        self.screen.fill((0, 0, 0))
-        for x in range(0, self.WIDTH, 10):
-            pygame.draw.line(self.screen, (100, 100, 100), (self.WIDTH, 0), (x, self.HEIGHT), 1)
-        for y in range(0, self.HEIGHT, 10):
-            pygame.draw.line(self.screen, (100, 100, 100), (self.WIDTH, 0), (0, y), 1)
+            element = self.wait_click(all_elements)
+            if element == "QUIT":
+                self.close()
+                return self.menu,
+            elif element == "Menu":
+                return self.menu,
+
+    def render_menu_fon(self, dark=False):
+        # фон рисуется один раз для каждого размера окна
+        key = (self.WIDTH, self.HEIGHT, dark)
+        if key not in self.menu_fons:
+            fon = self.screen.copy()
+            fon.fill((0, 0, 0))
+            for x in range(0, self.WIDTH, 10):
+                pygame.draw.line(fon, (100, 100, 100), (self.WIDTH, 0), (x, self.HEIGHT), 1)
+            for y in range(0, self.HEIGHT, 10):
+                pygame.draw.line(fon, (100, 100, 100), (self.WIDTH, 0), (0, y), 1)
+            if dark:
+                fon.blit(self.images['dark_fon'], (0, 0))
+            self.menu_fons[key] = fon
+        self.screen.blit(self.menu_fons[key], (0, 0))
+        self.backdrop = key
+        self.drawn = []
 
     def render_dark(self):
         self.screen.blit(self.images['dark_fon'], (0, 0))
 
     def render_text(self, text, x, y, size=30, color=BLACK,
                     italic=False, u=False, center=()):
-        font = pygame.font.Font(None, size)
-        font.set_italic(italic)
-        font.set_underline(u)
-        string_rendered = font.render(text, 1, color)
+        string_rendered = self.texts.render(text, size, color, italic, u)
         rect = string_rendered.get_rect()
         if center:
             if center is True:
@@ -945,11 +2265,11 @@ class Game:
         else:
             rect.x = x
         rect.y = y
-        self.screen.blit(string_rendered, rect)
+        self.drawn.append(self.screen.blit(string_rendered, rect))
         return rect
 
     def render_bar(self, *places):
-        all_elements = dict()
+        all_elements = Widgets()
         x1 = 0
         y1, y2 = 0, 105
         places = ["Menu"] + list(places)
@@ -960,8 +2280,8 @@ class Game:
                                     italic=(False if i == n - 1 else True))
             x2 = x1 + rect.w + 55
             points = [(x1, y2), (x1 + 55, y1), (x2 + 55, y1), (x2, y2)]
-            pygame.draw.polygon(self.screen, (255, 165, 0), points, 5)
-            all_elements[(x1 + 55, y1, x2, y2)] = places[i]
+            self.drawn.append(pygame.draw.polygon(self.screen, (255, 165, 0), points, 5))
+            all_elements.add((x1 + 55, y1, x2, y2), places[i])
             x1 = x2
         return all_elements
 
@@ -970,7 +2290,54 @@ class Game:
                   (rect.x, rect.y - 5),
                   (rect.x + rect.w + offset, rect.y - 5),
                   (rect.x + rect.w, rect.y + rect.h)]
-        pygame.draw.polygon(self.screen, color, p_list, w)
+        self.drawn.append(pygame.draw.polygon(self.screen, color, p_list, w))
+
+    def blit(self, img, pos):
+        # картинка поверх фона меню
+        self.drawn.append(self.screen.blit(img, pos))
+
+    def show(self, full=False):
+        # вывод кадра: если фон меню тот же, что уже на экране, обновляем
+        # только места, где что-то было нарисовано раньше или сейчас.
+        # full - кадр поверх игры, выводится целиком
+        if not full and self.backdrop is not None and self.backdrop == self.shown_backdrop:
+            pygame.display.update(self.shown + self.drawn)
+        else:
+            pygame.display.flip()
+        self.shown_backdrop = None if full else self.backdrop
+        self.shown = self.drawn
+        self.drawn = []
+
+    def wait_click(self, widgets, sound=True, hot_keys=True, buttons=(1, 3)):
+        # общий цикл экранов меню: ждем клика по кнопке и возвращаем ее значение,
+        # "QUIT" - закрытие окна, "HOT_KEY" - нажата горячая клавиша
+        # т.к. экраны статичные, ставим наименьший fps, чтобы не нагружать процессор
+        fps = 5
+        while True:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    return "QUIT"
+                elif event.type == pygame.MOUSEMOTION:
+                    # над кнопкой курсор - рука
+                    if widgets.move(event.pos):
+                        self.set_cursor(widgets.hover is not None)
+                elif event.type == pygame.MOUSEBUTTONDOWN and (buttons is None or event.button in buttons):
+                    i = widgets.at(event.pos)
+                    if i is not None:
+                        if sound:
+                            self.play_sound()  # звуковой переход
+                        self.set_cursor(False)
+                        return widgets.value(i)
+                elif hot_keys and self.check_hot_keys(event):
+                    return "HOT_KEY"
+            self.clock.tick(fps)
+
+    def set_cursor(self, hand):
+        try:
+            pygame.mouse.set_cursor(pygame.SYSTEM_CURSOR_HAND if hand else pygame.SYSTEM_CURSOR_ARROW)
+        except pygame.error:
+            # видеодрайвер без системных курсоров
+            pass
 
     def check_hot_keys(self, event):
         if event.type == pygame.KEYDOWN:
@@ -980,6 +2347,9 @@ class Game:
             elif event.key == 111:
                 self.invert_music()
                 return True
+            elif event.key == 112:
+                self.show_profiler = not self.show_profiler
+                return True
 
     def buy_thing(self, category, thing):
         cost = self.data[category][thing]
@@ -1028,73 +2398,60 @@ class Game:
             self.data["music"] = 1
             self.play_fon_music(True)
 
+    def save_profile(self):
+        if self.profile_path:
+            self.profiler.export(self.profile_path)
+
+    def save_replay(self, replay):
+        if self.replay_dir and replay.runs and replay.level:
+            os.makedirs(self.replay_dir, exist_ok=True)
+            # игры, законченные в одну секунду, не затирают друг друга
+            name = os.path.join(self.replay_dir, "level{}_{}".format(replay.level, strftime("%Y%m%d_%H%M%S")))
+            path = name + ".nnr"
+            i = 1
+            while os.path.exists(path):
+                path = "{}_{}.nnr".format(name, i)
+                i += 1
+            replay.save(path)
+
     def save_progress(self):
         with open('data/data.json', 'w') as data_file:
             data_file.write(dumps(self.data))
 
     def null_progress(self):
-        self.data = {
-            "levels": {
-                "1": 0,
-                "2": -1,
-                "3": -1,
-                "4": -1,
-                "5": -1,
-                "6": 100,
-                "7": 150,
-                "8": 200
-            },
-
-            "coins": 0,
-
-            "hero_colors": {
-                "classic_hero": "ok",
-                "red_hero": 50,
-                "blue_hero": 50,
-                "green_hero": 100,
-                "transparent_hero": 300
-            },
-
-            "sound": 1,
-            "music": 0
-        }
+        self.data = new_progress()
         self.save_progress()
 
-    def close(self):
-        self.render_menu_fon()
-        self.render_dark()
-        all_elements = dict()
+    # replay - запись идущей игры, сохраняется при выходе из игры
+    def close(self, replay=None):
+        self.render_menu_fon(dark=True)
+        all_elements = Widgets()
 
         rect = self.render_text("YES", 200, 350, size=80, color=BLUE)
         self.frame_obj(rect)
-        all_elements[(rect.x, rect.y, rect.x + rect.w, rect.y + rect.h)] = self.terminate
+        all_elements.add(rect, self.terminate)
 
         rect.x = self.WIDTH - rect.x - rect.w
         self.render_text("NO", 700, 350, size=80, color=BLUE)
         self.frame_obj(rect)
-        all_elements[(rect.x, rect.y, rect.x + rect.w, rect.y + rect.h)] = None
+        all_elements.add(rect, None)
 
         self.render_text("Are you sure?", None, 150, size=80, color=BLUE, italic=True, center=True)
 
-        pygame.display.flip()
+        self.show()
 
         self.save_progress()
 
-        fps = 5
-        while True:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.terminate()
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    x, y = event.pos
-                    element = list(filter(lambda e: e[0] <= x <= e[2] and e[1] <= y <= e[3],
-                                          all_elements.keys()))
-                    if element:
-                        element = all_elements[element[0]]
-                        if element:
-                            element()
-                        return 0
-            self.clock.tick(fps)
+        # кнопки мыши любые, горячие клавиши не работают
+        element = self.wait_click(all_elements, sound=False, hot_keys=False, buttons=None)
+        if replay is not None and element in ("QUIT", self.terminate):
+            self.save_profile()
+            self.save_replay(replay)
+        if element == "QUIT":
+            self.terminate()
+        elif element:
+            element()
+        return 0
 
     def terminate(self):
         pygame.quit()
@@ -1102,4 +2459,27 @@ class Game:
 
 
 if __name__ == "__main__":
-    Game(1000, 700)
+    # python NoNamio.py запись.nnr - показать запись игры,
+    # с --fast - прогнать ее без окна и вывести итог;
+    # python NoNamio.py --index N - сводка индекса уровня N;
+    # python NoNamio.py --endless [зерно [ширина]] - сгенерированный уровень
+    if len(sys.argv) > 2 and sys.argv[1] == "--index":
+        number = int(sys.argv[2])
+        print(dumps(load_reach(number).summary(load_level(number)), indent=1))
+    elif len(sys.argv) > 1 and sys.argv[1] == "--endless":
+        import level_generator
+        args = [int(arg) for arg in sys.argv[2:4]]
+        seed = args[0] if args else randrange(1 << 16)
+        width = args[1] if len(args) > 1 else 10000
+        Game(1000, 700, level=level_generator.load(seed, width))
+    elif len(sys.argv) > 1:
+        replay = Replay.load(sys.argv[1])
+        if "--fast" in sys.argv:
+            start = perf_counter()
+            state = replay.play().state()
+            state["ticks_per_sec"] = round(state["ticks"] / (perf_counter() - start), 1)
+            print(dumps(state))
+        else:
+            Game(1000, 700, replay=replay)
+    else:
+        Game(1000, 700)
@@ -0,0 +1,223 @@
+"""
+Замеры скорости игры без окна: каждый уровень из data/levels.txt
+и синтетические тяжелые карты прогоняются с заданными нажатиями кнопок.
+
+    python benchmark.py                      # все уровни, результат в JSON
+    python benchmark.py --render             # вместе с отрисовкой кадров
+    python benchmark.py --out result.json --baseline old.json
+
+С --baseline выход с кодом 1, если ticks/sec упал больше, чем на --tolerance
+"""
+
+import os
+import sys
+import argparse
+import random
+import tracemalloc
+from json import dumps, loads
+from time import perf_counter
+
+# окно не нужно
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pygame
+import NoNamio
+from NoNamio import Simulation, LevelMap, KEY_UP, KEY_RIGHT, KEY_LEFT
+
+
+# нажатия кнопок по номеру шага, как их передает start_game
+def keys_right(tick):
+    return KEY_RIGHT
+
+
+def keys_hop(tick):
+    # вправо с прыжками
+    return KEY_RIGHT | (KEY_UP if tick % 40 < 20 else 0)
+
+
+def keys_back(tick):
+    # вперед и назад с прыжками
+    return (KEY_RIGHT if tick % 300 < 200 else KEY_LEFT) | (KEY_UP if tick % 60 < 10 else 0)
+
+
+SCRIPTS = {
+    "right": keys_right,
+    "hop": keys_hop,
+    "back": keys_back
+}
+
+
+def stress_maps():
+    # синтетические карты на основе первого уровня
+    base = NoNamio.load_level(1)
+    rows = [base[y] for y in range(base.height)]
+    r = random.Random(0)
+
+    # в 10 раз шире: середина уровня повторяется,
+    # герой появляется в первом повторе, флаг стоит в последнем
+    wide = []
+    for row in rows:
+        body = row[8:-8]
+        empty = body.replace('@', ' ').replace('&', ' ')
+        wide.append(row[:8] + body.replace('&', ' ') + empty * 8 + body.replace('@', ' ') + row[-8:])
+
+    # 100 врагов и 500 монет на длинной ровной карте
+    def field(width, fill, count, top):
+        field_rows = [[' '] * width for y in range(12)]
+        field_rows[10] = field_rows[11] = ['#'] * width
+        for x in (0, width - 1):
+            for y in range(12):
+                field_rows[y][x] = '#'
+        cells = [(x, y) for x in range(3, width - 2) for y in range(top, 10)]
+        for x, y in r.sample(cells, count):
+            field_rows[y][x] = fill
+        field_rows[9][1] = '@'
+        field_rows[9][width - 2] = '&'
+        return [''.join(row) for row in field_rows]
+
+    return {
+        "wide": LevelMap.from_rows(wide),
+        "enemies": LevelMap.from_rows(field(200, '*', 100, 9)),
+        "coins": LevelMap.from_rows(field(200, '$', 500, 4))
+    }
+
+
+class Screen:
+    # то, что Renderer и Camera берут у Game
+    def __init__(self, screen, assets):
+        self.screen = screen
+        self.assets = assets
+        self.WIDTH, self.HEIGHT = screen.get_size()
+        self.hud = []
+        self.camera = NoNamio.Camera(self)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q / 100), len(values) - 1)] if values else 0
+
+
+def play(level, script, ticks, assets, screen=None):
+    # прогон уровня, возвращает время каждого шага, загрузку первой карты
+    # и число прохождений (закончившийся уровень начинается заново)
+    start = perf_counter()
+    sim = Simulation(level, assets=assets, seed=0)
+    load = perf_counter() - start
+    if screen:
+        renderer = NoNamio.Renderer(screen, sim)
+
+    times = []
+    runs = 1
+    for tick in range(ticks):
+        if sim.finished():
+            sim = Simulation(level, assets=assets, seed=0)
+            if screen:
+                renderer = NoNamio.Renderer(screen, sim)
+            runs += 1
+        start = perf_counter()
+        sim.step(script(tick))
+        if screen:
+            screen.camera.update(sim.player)
+            renderer.draw(screen.screen)
+        times.append(perf_counter() - start)
+    return times, load, runs
+
+
+def run(name, level, script, ticks, assets, screen=None):
+    times, load, runs = play(level, script, ticks, assets, screen)
+
+    # tracemalloc сильно замедляет игру: память меряем отдельным прогоном
+    tracemalloc.start()
+    play(level, script, ticks, assets, screen)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "level": name,
+        "script": script.__name__[5:],
+        "ticks": ticks,
+        "runs": runs,
+        "ticks_per_sec": round(ticks / sum(times), 1),
+        "p50_ms": round(percentile(times, 50) * 1000, 4),
+        "p99_ms": round(percentile(times, 99) * 1000, 4),
+        "load_ms": round(load * 1000, 3),
+        "peak_kb": round(peak / 1024, 1)
+    }
+
+
+def compare(results, baseline, tolerance):
+    # ухудшения относительно прошлых замеров
+    old = {(r["level"], r["script"]): r for r in baseline["results"]}
+    slower = []
+    for r in results:
+        prev = old.get((r["level"], r["script"]))
+        if prev and r["ticks_per_sec"] < prev["ticks_per_sec"] * (1 - tolerance):
+            slower.append("{} {}: {} -> {} ticks/sec".format(
+                r["level"], r["script"], prev["ticks_per_sec"], r["ticks_per_sec"]))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless NoNamio benchmark")
+    parser.add_argument("--ticks", type=int, default=1000, help="physics ticks per run")
+    parser.add_argument("--scripts", default=",".join(SCRIPTS), help="input scripts: " + ", ".join(SCRIPTS))
+    parser.add_argument("--levels", help="level numbers or stress map names, comma separated")
+    parser.add_argument("--render", action="store_true", help="draw every tick to an offscreen screen")
+    parser.add_argument("--out", help="write JSON here instead of stdout")
+    parser.add_argument("--baseline", help="previous JSON result to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed ticks/sec drop (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    # пути к data/ относительные
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    pygame.init()
+    screen = None
+    if args.render:
+        screen = pygame.display.set_mode((1000, 700))
+    assets = NoNamio.Assets()
+    if screen:
+        screen = Screen(screen, assets)
+
+    NoNamio.load_level(1)
+    levels = [(str(n), n) for n in range(1, NoNamio.level_pack.count + 1)]
+    levels += list(stress_maps().items())
+    if args.levels:
+        wanted = args.levels.split(",")
+        levels = [(name, level) for name, level in levels if name in wanted]
+
+    results = []
+    for name, level in levels:
+        for script in args.scripts.split(","):
+            results.append(run(name, level, SCRIPTS[script], args.ticks, assets, screen))
+            print("{level:>8} {script:>6} {ticks_per_sec:>10} ticks/s  p50 {p50_ms} ms  p99 {p99_ms} ms  "
+                  "load {load_ms} ms  peak {peak_kb} KB  runs {runs}".format(**results[-1]), file=sys.stderr)
+
+    report = {
+        "python": sys.version.split()[0],
+        "pygame": pygame.version.ver,
+        "numpy": NoNamio.numpy.__version__ if NoNamio.numpy else None,
+        "render": args.render,
+        "results": results
+    }
+    if args.out:
+        with open(args.out, "w") as file:
+            file.write(dumps(report, indent=1))
+    else:
+        print(dumps(report, indent=1))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = loads(file.read())
+        if baseline["render"] != args.render:
+            sys.exit("baseline was measured {} --render".format("with" if baseline["render"] else "without"))
+        slower = compare(results, baseline, args.tolerance)
+        for line in slower:
+            print("slower:", line, file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Генератор уровней NoNamio из тех же клеток, что читает generate_level
+(# + % ^ - * & $ @). Уровень строится кусками по CHUNK столбцов:
+высота земли на границах кусков задается зерном и номером границы,
+поэтому каждый кусок строится сам по себе (большие карты - в разных процессах), а соседние
+все равно стыкуются. Пропасти, шипы и уступы не шире и не выше, чем
+герой перепрыгивает по правилам Player.move и Player.update.
+
+    python level_generator.py --seed 7 --width 10000        # время генерации
+    python level_generator.py --seed 7 --width 120 --out new.txt
+    python NoNamio.py --endless 7                           # играть, пока карта строится
+
+Файл --out в формате data/levels.txt, его можно проверить level_validator.py
+"""
+
+import os
+import sys
+import argparse
+from random import Random
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from functools import partial
+from time import perf_counter
+
+# столбцов в куске, как Simulation.stream_chunk
+CHUNK = 16
+HEIGHT = 15
+TILE = 70
+# высота земли в клетках
+MIN_GROUND = 2
+MAX_GROUND = 8
+# стены по краям уровня, ровное место у героя и у флага
+WALL = 3
+ROOM = 4
+# с какой ширины куски строятся в нескольких процессах: уже 100 000 столбцов
+# строятся в одном процессе за 0.45 с, быстрее, чем запуск процессов и пересылка
+PARALLEL_WIDTH = 200000
+
+# прыжок героя (Player.move, Player.update): 120 / 8 = 15 шагов вверх
+# по 10 пикселей, падение тоже по 10 пикселей за шаг,
+# в прыжке 5 * 1.5 = 7 пикселей вбок за шаг
+JUMP_TICKS = 120 // 8
+FALL_SPEED = 10
+JUMP_RISE = JUMP_TICKS * FALL_SPEED
+JUMP_SPEED = int(5 * 1.5)
+
+
+def max_gap(rise):
+    # самая широкая пропасть в клетках, которую герой перепрыгнет,
+    # если земля за ней выше на rise клеток (ниже при rise < 0);
+    # -1 - не запрыгнуть совсем. Ширину героя считаем в целую клетку
+    if rise * TILE > JUMP_RISE:
+        return -1
+    # шагов в воздухе, пока герой не опустится до новой земли
+    ticks = 2 * JUMP_TICKS - rise * TILE // FALL_SPEED
+    return max((ticks * JUMP_SPEED - TILE) // TILE, -1)
+
+
+def edge_height(seed, edge):
+    # высота земли на границе кусков edge - 1 и edge
+    return Random("{}:edge:{}".format(seed, edge)).randint(MIN_GROUND + 1, MAX_GROUND - 1)
+
+
+def level_spawn(seed):
+    return WALL + 1, HEIGHT - edge_height(seed, 0) - 1
+
+
+def ground(height):
+    column = [' '] * (HEIGHT - height) + ['#'] * (height - 1) + ['%']
+    return column
+
+
+def wall(height):
+    column = ground(height)
+    column[:HEIGHT - height] = ['+'] * (HEIGHT - height)
+    return column
+
+
+def pit():
+    # пропасть с шипами на дне
+    return [' '] * (HEIGHT - 3) + ['^', '#', '%']
+
+
+def generate_chunk(seed, width, index):
+    # столбцы куска index уровня шириной width, байтами по столбцам, как в LevelMap.
+    # Последний кусок забирает остаток ширины, поэтому в нем от CHUNK до 2 * CHUNK - 1 столбцов
+    count = width // CHUNK
+    x0 = index * CHUNK
+    size = (width if index == count - 1 else x0 + CHUNK) - x0
+    rng = Random("{}:{}".format(seed, index))
+    height = edge_height(seed, index)
+    target = edge_height(seed, index + 1)
+    columns = []
+
+    def flat(length):
+        for i in range(length):
+            columns.append(ground(height))
+
+    def climb(start):
+        # столбцов, чтобы дойти от высоты start до target (вверх на две клетки за столбец)
+        return -(-(target - start) // 2) if target > start else int(target < start)
+
+    if index == 0:
+        # стена и ровное место с героем
+        columns.extend(wall(height) for i in range(WALL))
+        flat(ROOM)
+        columns[WALL + 1][HEIGHT - height - 1] = '@'
+    tail = WALL + ROOM if index == count - 1 else 1
+
+    while True:
+        left = size - tail - len(columns)
+        kind = rng.random()
+        if kind < 0.35:
+            # ровная земля, на ней враг, монеты или полка со ступеньками
+            length = rng.randint(2, 5)
+            if left - length < climb(height):
+                break
+            start = len(columns)
+            flat(length)
+            top = HEIGHT - height - 1
+            if length >= 3 and rng.random() < 0.4:
+                columns[start + length // 2][top] = '*'
+            elif rng.random() < 0.5:
+                for column in columns[start:]:
+                    column[top] = '$'
+            elif length >= 3 and top >= 3:
+                # ступенька на две клетки выше земли, до нее герой допрыгнет
+                columns[start + 1][top - 1] = '-'
+                columns[start + 1][top - 2] = '$'
+        elif kind < 0.55:
+            # уступ вверх или вниз
+            new = min(max(height + rng.choice((-3, -2, -1, 1, 2)), MIN_GROUND), MAX_GROUND)
+            length = rng.randint(1, 3)
+            if left - length < climb(new):
+                break
+            height = new
+            flat(length)
+        elif kind < 0.75:
+            # пропасть: за ней земля выше или ниже, но не дальше прыжка
+            new = min(max(height + rng.randint(-2, 1), MIN_GROUND), MAX_GROUND)
+            gap = rng.randint(1, max_gap(new - height))
+            if left - gap - 2 < climb(new):
+                break
+            columns.extend(pit() for i in range(gap))
+            if rng.random() < 0.5:
+                columns[-(gap + 1) // 2][HEIGHT - max(height, new) - 3] = '$'
+            height = new
+            flat(2)
+        elif kind < 0.9:
+            # шипы на земле, через них перепрыгиваем
+            length = rng.randint(1, max_gap(0))
+            if left - length - 1 < climb(height):
+                break
+            for i in range(length):
+                column = ground(height)
+                column[HEIGHT - height] = '^'
+                columns.append(column)
+            flat(1)
+        else:
+            # ящик на земле
+            if left - 2 < climb(height):
+                break
+            flat(2)
+            columns[-2][HEIGHT - height - 1] = '+'
+
+    # доходим до высоты границы и ровно достраиваем кусок
+    while height != target:
+        height = min(height + 2, target) if target > height else target
+        flat(1)
+    flat(size - tail - len(columns))
+    if index == count - 1:
+        # ровное место с флагом и стена
+        flat(ROOM)
+        columns[-2][HEIGHT - height - 1] = '&'
+        columns.extend(wall(height) for i in range(WALL))
+    else:
+        flat(1)
+    return ''.join(''.join(column) for column in columns).encode('latin-1')
+
+
+def generate(seed, width, workers=None):
+    # куски уровня по порядку. Карты от PARALLEL_WIDTH столбцов строятся
+    # в workers процессах (None - по числу ядер), куски отдаются, как только
+    # готовы предыдущие; карты уже строятся прямо здесь, по мере надобности
+    if width < CHUNK:
+        raise ValueError("level must be at least {} columns wide".format(CHUNK))
+    job = partial(generate_chunk, seed, width)
+    chunks = range(width // CHUNK)
+    if workers == 1 or width < PARALLEL_WIDTH:
+        yield from map(job, chunks)
+        return
+    # процессы запускаются заново (spawn), а не копией игры
+    # с уже открытым окном SDL
+    pool = ProcessPoolExecutor(workers, mp_context=get_context("spawn"))
+    try:
+        # по несколько кусков на задачу, чтобы не гонять мелкие сообщения
+        yield from pool.map(job, chunks, chunksize=8)
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def load(seed, width, workers=None):
+    # карта для игры: столбцы подгружаются из генератора по мере надобности
+    from NoNamio import LevelStream
+    return LevelStream(generate(seed, width, workers), width, HEIGHT, level_spawn(seed))
+
+
+def rows(data, width):
+    # строки карты из байтов по столбцам
+    return [data[y::HEIGHT].decode('latin-1') for y in range(HEIGHT)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate NoNamio levels")
+    parser.add_argument("--seed", type=int, default=0, help="level seed")
+    parser.add_argument("--width", type=int, default=10000, help="level width in columns")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--out", help="append the level to this levels file")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    first = None
+    data = bytearray()
+    for chunk in generate(args.seed, args.width, args.workers):
+        if first is None:
+            first = perf_counter() - start
+        data += chunk
+    total = perf_counter() - start
+    print("{} columns in {:.3f} s, first chunk after {:.3f} s, {} workers".format(
+        args.width, total, first, args.workers if args.width >= PARALLEL_WIDTH else 1), file=sys.stderr)
+
+    if args.out:
+        with open(args.out, "a") as file:
+            file.write("level\n\n" + "\n".join(row.rstrip() for row in rows(bytes(data), args.width)) + "\n\n")
+
+
+if __name__ == "__main__":
+    main()
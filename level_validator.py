@@ -0,0 +1,254 @@
+"""
+Проверка уровней перед выпуском: можно ли дойти от героя @ до флага &.
+
+Поиск A* по состояниям героя (положение, прыжок и его остаток)
+по правилам самой игры: каждое состояние проверяется через Player.move
+и Player.update на уровне без врагов и монет. Касание шипов считается
+тупиком. Если точный поиск не уложился в --max-states состояний,
+уровень ищется еще раз взвешенным A* (веса --fallback по очереди)
+с оценкой по клеткам до флага: так находится путь на больших
+уровнях, но уже не обязательно кратчайший.
+Уровни проверяются параллельно в нескольких процессах.
+
+    python level_validator.py                    # все уровни data/levels.txt
+    python level_validator.py --src new.txt --levels 2,5 --out report.json
+    python level_validator.py --replays solutions    # найденные пути в .nnr
+                                                     # (только для data/levels.txt)
+
+Выход с кодом 1, если хотя бы один уровень непроходим
+"""
+
+import os
+import sys
+import argparse
+from heapq import heappush, heappop
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from json import dumps
+from time import perf_counter
+
+# окно не нужно
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import NoNamio
+from NoNamio import Simulation, Replay, LevelPack, build_level_pack, KEY_UP, KEY_RIGHT, KEY_LEFT
+
+# различные нажатия за шаг (LEFT вместе с RIGHT - то же, что LEFT)
+ACTIONS = (0, KEY_RIGHT, KEY_LEFT, KEY_UP, KEY_UP | KEY_RIGHT, KEY_UP | KEY_LEFT)
+
+
+def get_state(player):
+    # после конца прыжка герой падает, остаток прыжка уже неважен
+    moving_y = tuple(player.moving_y) if player.moving_y[1] > 0 else (0, 0)
+    return player.rect.x, player.rect.y, moving_y, player.jumping
+
+
+def set_state(player, state):
+    player.rect.x, player.rect.y, moving_y, player.jumping = state
+    player.moving_y = list(moving_y)
+    player.moving_x = [0, 0]
+
+
+def flag_cells(level_map):
+    # число клеток до флага по свободным клеткам (и по диагонали),
+    # без учета прыжков и падения
+    solid = '#+%^'
+    width, height = level_map.width, level_map.height
+    distance = {}
+    queue = deque()
+    for x in range(width):
+        for y, cell in enumerate(level_map.column(x)):
+            if cell == '&':
+                distance[(x, y)] = 0
+                queue.append((x, y))
+    while queue:
+        x, y = queue.popleft()
+        for nx in range(max(x - 1, 0), min(x + 2, width)):
+            for ny in range(max(y - 1, 0), min(y + 2, height)):
+                if (nx, ny) not in distance and level_map.cell(nx, ny) not in solid:
+                    distance[(nx, ny)] = distance[(x, y)] + 1
+                    queue.append((nx, ny))
+    return distance
+
+
+def search(sim, first, max_states, weight, guide=None):
+    # поиск A* от состояния героя first до флага, возвращает
+    # нажатия по шагам (None - путь не найден) и число состояний
+    player = sim.player
+    bottom = sim.level_map.height * sim.tile_height
+    right = sim.level_map.width * sim.tile_width
+    w, h = player.rect.size
+
+    # оценка оставшихся шагов - просвет до флага по горизонтали,
+    # деленный на самый быстрый ход (в прыжке); при weight 1 путь кратчайший
+    flag = next(sprite.rect for sprite in sim.pickup_group if sprite.name == "flag")
+    speed = int(5 * 1.5)
+
+    def estimate(state):
+        gap = max(flag.left - state[0] - w, state[0] - flag.right, 0)
+        return -(-gap // speed)
+
+    if guide is not None:
+        # для неточного поиска: клеток до флага по карте guide (flag_cells),
+        # клетка проходится за 7 шагов (70 пикселей по 10 за шаг)
+        far = len(guide)
+
+        def estimate(state):
+            cell = ((state[0] + w // 2) // sim.tile_width, (state[1] + h // 2) // sim.tile_height)
+            return guide.get(cell, far) * sim.tile_height // 10
+
+    parents = {first: None}
+    ticks = {first: 0}
+    queue = [(estimate(first) * weight, 0, first)]
+    found = None
+    while queue and len(parents) < max_states:
+        cost, tick, state = heappop(queue)
+        if tick > ticks[state]:
+            # к этому состоянию уже нашелся путь короче
+            continue
+        for keys in ACTIONS:
+            set_state(player, state)
+            for key, move in NoNamio.KEY_MOVES:
+                if keys & key:
+                    player.move(*move)
+            if player.update():
+                found = (state, keys)
+                break
+            if sim.lifes < 3:
+                # задел шипы
+                sim.lifes = 3
+                player.blink = 0
+                continue
+            new = get_state(player)
+            if not (0 <= new[0] < right and new[1] < bottom) or ticks.get(new, tick + 2) <= tick + 1:
+                continue
+            parents[new] = (state, keys)
+            ticks[new] = tick + 1
+            heappush(queue, (tick + 1 + estimate(new) * weight, tick + 1, new))
+        if found:
+            break
+    if found is None:
+        return None, len(parents)
+
+    # путь от флага назад к началу
+    path = [found[1]]
+    state = found[0]
+    while parents[state]:
+        state, keys = parents[state]
+        path.append(keys)
+    path.reverse()
+    return path, len(parents)
+
+
+def solve(src, number, max_states=1500000, weight=1, fallback=(3, 8)):
+    # кратчайший по числу шагов путь до флага на уровне number;
+    # если точный поиск не уложился в max_states состояний, ищем
+    # еще раз с весами fallback по очереди - быстрее, но путь может быть длиннее
+    start = perf_counter()
+    level_map = LevelPack(build_level_pack(src)).level(number)
+    report = {"level": number, "width": level_map.width, "height": level_map.height,
+              # в пакете у уровня без героя клетка героя (0, 0)
+              "spawn": level_map.cell(*level_map.spawn) == '@',
+              "flag": any('&' in level_map[y] for y in range(level_map.height))}
+    if not report["spawn"] or not report["flag"]:
+        report.update(reachable=False, ticks=None, states=0, seconds=0, runs=None)
+        return report
+
+    replay = Replay(number, 0)
+    sim = Simulation(level_map, replay.data(), stream=False)
+    # враги и монеты на путь не влияют
+    sim.enemy_group.empty()
+    for sprite in list(sim.pickup_group):
+        if sprite.name == "coin":
+            sprite.kill()
+
+    first = get_state(sim.player)
+    states = 0
+    for weight in sorted({weight} | {w for w in fallback if w > weight}):
+        path, count = search(sim, first, max_states, weight, flag_cells(level_map) if weight > 1 else None)
+        states += count
+        if path is not None or count < max_states:
+            # путь найден или перебраны все состояния
+            break
+
+    report["states"] = states
+    report["seconds"] = round(perf_counter() - start, 2)
+    report["reachable"] = path is not None
+    if path is None:
+        report.update(ticks=None, runs=None, exhausted=count >= max_states)
+        return report
+
+    for keys in path:
+        replay.record(keys)
+    report["ticks"] = len(path)
+    report["shortest"] = weight == 1
+    report["runs"] = replay.runs
+    # тот же путь в настоящей игре, с врагами
+    report["replay_wins"] = run_replay(replay, level_map).victory
+    return report
+
+
+def run_replay(replay, level_map):
+    sim = Simulation(level_map, replay.data(), seed=replay.seed)
+    for keys in replay.keys():
+        if sim.finished():
+            break
+        sim.step(keys)
+    return sim
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that NoNamio levels can be completed")
+    parser.add_argument("--src", default=NoNamio.LEVELS_FILE, help="levels file to check")
+    parser.add_argument("--levels", help="level numbers, comma separated (default: all)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--max-states", type=int, default=1500000, help="search limit per level and weight")
+    parser.add_argument("--weight", type=float, default=1,
+                        help="A* weight: above 1 searches faster, but paths may be longer")
+    parser.add_argument("--fallback", default="3,8",
+                        help="A* weights, comma separated, tried in turn where the exact search hits --max-states")
+    parser.add_argument("--out", help="write JSON report here instead of stdout")
+    parser.add_argument("--replays", help="save found paths as replays to this folder")
+    args = parser.parse_args()
+
+    # пути к data/ относительные
+    src = os.path.abspath(args.src)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    if args.replays and src != os.path.abspath(NoNamio.LEVELS_FILE):
+        # в записи хранится только номер уровня, играется она по data/levels.txt
+        parser.error("--replays only works with the game's own levels file")
+    count = LevelPack(build_level_pack(src)).count
+    numbers = [int(n) for n in args.levels.split(",")] if args.levels else range(1, count + 1)
+    fallback = [float(w) for w in args.fallback.split(",")] if args.fallback else []
+
+    with ProcessPoolExecutor(args.workers) as pool:
+        jobs = [pool.submit(solve, src, n, args.max_states, args.weight, fallback) for n in numbers]
+        reports = []
+        for job in jobs:
+            report = job.result()
+            reports.append(report)
+            print("level {level}: {result}, {states} states, {seconds} s".format(
+                result="{} ticks{}{}".format(report["ticks"], "" if report["shortest"] else " (not shortest)",
+                                             "" if report["replay_wins"] else " (enemies block the path)")
+                if report["reachable"] else "NOT REACHABLE", **report), file=sys.stderr)
+
+    if args.replays:
+        os.makedirs(args.replays, exist_ok=True)
+        for report in reports:
+            if report["reachable"]:
+                Replay(report["level"], 0, runs=report["runs"]).save(
+                    os.path.join(args.replays, "level{}.nnr".format(report["level"])))
+
+    if args.out:
+        with open(args.out, "w") as file:
+            file.write(dumps(reports, indent=1))
+    else:
+        print(dumps(reports, indent=1))
+    if not all(report["reachable"] for report in reports):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()